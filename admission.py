@@ -0,0 +1,353 @@
+"""Per-route admission control and load shedding for Warbler.
+
+Every endpoint belongs to a priority class ('write', 'expensive',
+'export' or 'default'). Each class has its own concurrency limit, so a
+slow database that backs up the homepage can't use up the workers that
+/login and static files need. A request that can't get a slot within its
+class's queue deadline, or that finds the queue already full, is shed
+right away with a 503 and a Retry-After header.
+
+Slots are shared in one of two ways:
+
+- With ADMISSION_SLOT_DIR set, each slot is a file in that directory and
+  holding a slot means holding an flock on it. Places in the wait queue
+  are files too. Every worker process on the host shares the limits,
+  which is what sync workers (one request per process) need, and the
+  in-flight and queue-depth gauges are host-wide.
+- Without it, slots are a semaphore in each process. That only limits
+  anything with threaded workers, and the gauges are per process.
+
+With ADMISSION_QUEUE_HEADER set (e.g. 'X-Request-Start', as set by
+nginx or Heroku), time the request already spent queued upstream counts
+toward its class's max_wait. A request that waited too long in the
+backlog is shed without doing any work.
+
+Configure with:
+
+    ADMISSION_ENABLED       turn the whole thing on/off
+    ADMISSION_CLASSES       {class: {'limit', 'max_queue', 'max_wait',
+                                     'retry_after'}}
+    ADMISSION_ROUTES        {endpoint: class}; others are 'default'
+    ADMISSION_EXEMPT        endpoints never limited ('static', 'metrics')
+    ADMISSION_SLOT_DIR      share slots across processes (see above)
+    ADMISSION_QUEUE_HEADER  proxy header holding the request start time
+"""
+
+import fcntl
+import os
+import random
+import threading
+import time
+
+from flask import g, request
+
+from metrics import Counter
+
+ADMITTED = Counter('admission_admitted_total', 'Requests admitted.',
+                   ['class'])
+
+SHED = Counter('admission_shed_total', 'Requests shed with a 503.',
+               ['class'])
+
+QUEUE_SECONDS = Counter('admission_queue_seconds_total',
+                        'Time admitted or shed requests spent queued.',
+                        ['class'])
+
+DEFAULT_CLASSES = {
+    'write': {'limit': 8, 'max_queue': 16, 'max_wait': 0.5,
+              'retry_after': 1},
+    'expensive': {'limit': 4, 'max_queue': 8, 'max_wait': 0.25,
+                  'retry_after': 2},
+    'default': {'limit': 32, 'max_queue': 64, 'max_wait': 1.0,
+                'retry_after': 1},
+    'export': {'limit': 2, 'max_queue': 0, 'max_wait': 0,
+               'retry_after': 30},
+}
+
+DEFAULT_ROUTES = {
+    'warbler.messages_add': 'write',
+    'warbler.messages_destroy': 'write',
+    'warbler.add_follow': 'write',
+    'warbler.stop_following': 'write',
+    'warbler.bulk_follow': 'write',
+    'warbler.homepage': 'expensive',
+    'warbler.list_users': 'expensive',
+    'warbler.users_show': 'expensive',
+    'warbler.export_user': 'export',
+}
+
+DEFAULT_EXEMPT = ('static', 'metrics')
+
+
+class ThreadSlots:
+    """Slots shared by the threads of one process."""
+
+    def __init__(self, limit):
+        self._sem = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+    def acquire(self, timeout):
+        """Return a token for a free slot, or None after `timeout`."""
+
+        if timeout > 0:
+            ok = self._sem.acquire(timeout=timeout)
+        else:
+            ok = self._sem.acquire(blocking=False)
+        if not ok:
+            return None
+
+        with self._lock:
+            self._in_use += 1
+        return True
+
+    def release(self, token):
+        with self._lock:
+            self._in_use -= 1
+        self._sem.release()
+
+    def in_use(self):
+        """How many slots are held in this process."""
+
+        return self._in_use
+
+
+class FileSlots:
+    """Slots shared by every process on the host: one flock'd file each."""
+
+    poll_interval = 0.005
+
+    def __init__(self, directory, name, limit):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"{name}.{i}.slot")
+                      for i in range(limit)]
+
+    def _try_acquire(self):
+        for path in random.sample(self.paths, len(self.paths)):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def acquire(self, timeout):
+        """Return a locked fd for a free slot, or None after `timeout`."""
+
+        deadline = time.monotonic() + timeout
+        while True:
+            fd = self._try_acquire()
+            if fd is not None or time.monotonic() >= deadline:
+                return fd
+            time.sleep(self.poll_interval)
+
+    def release(self, fd):
+        # Closing the fd drops the lock, even if the process dies.
+        os.close(fd)
+
+    def in_use(self):
+        """How many slots are held right now, by any process.
+
+        Probes each file with a non-blocking lock, so a free slot is
+        briefly taken; a request racing the probe just polls once more.
+        """
+
+        busy = 0
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                busy += 1
+            finally:
+                os.close(fd)
+        return busy
+
+
+class Gate:
+    """Concurrency limit with a bounded, deadline-limited wait queue."""
+
+    def __init__(self, name, limit, max_queue, max_wait, retry_after,
+                 slot_dir=None):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        # Holding a ticket is holding a place in the wait queue.
+        if slot_dir:
+            self._slots = FileSlots(slot_dir, name, limit)
+            self._tickets = FileSlots(slot_dir, f"{name}-queue", max_queue)
+        else:
+            self._slots = ThreadSlots(limit)
+            self._tickets = ThreadSlots(max_queue)
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.shed = 0
+        self.queue_seconds = 0.0
+
+    def acquire(self, already_waited=0.0):
+        """Try to take a slot.
+
+        `already_waited` is time spent queued before reaching us. Returns
+        a token to pass to release() if admitted, or None if shed.
+        """
+
+        token = None
+        if already_waited <= self.max_wait:
+            token = self._slots.acquire(0)
+        if token is not None:
+            self._record(token, 0.0)
+            return token
+
+        if already_waited >= self.max_wait:
+            self._record(None, 0.0)
+            return None
+
+        ticket = self._tickets.acquire(0)
+        if ticket is None:
+            self._record(None, 0.0)
+            return None
+
+        start = time.perf_counter()
+        try:
+            token = self._slots.acquire(self.max_wait - already_waited)
+        finally:
+            self._tickets.release(ticket)
+        waited = time.perf_counter() - start
+
+        self._record(token, waited)
+        return token
+
+    def _record(self, token, waited):
+        with self._lock:
+            self.queue_seconds += waited
+            if token is not None:
+                self.admitted += 1
+            else:
+                self.shed += 1
+
+        QUEUE_SECONDS.inc(waited, **{'class': self.name})
+        if token is not None:
+            ADMITTED.inc(**{'class': self.name})
+        else:
+            SHED.inc(**{'class': self.name})
+
+    def release(self, token):
+        """Give back a slot taken by a successful acquire()."""
+
+        self._slots.release(token)
+
+    def stats(self):
+        """Snapshot of this gate's gauges and counters.
+
+        in_flight and queued are host-wide with a slot dir, otherwise for
+        this process. The counters are always for this process.
+        """
+
+        in_flight = self._slots.in_use()
+        queued = self._tickets.in_use()
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': in_flight,
+                'queued': queued,
+                'admitted': self.admitted,
+                'shed': self.shed,
+                'queue_seconds': self.queue_seconds,
+            }
+
+
+def upstream_wait(header, now=None):
+    """Seconds since the proxy timestamp in `header`, or 0.0.
+
+    Accepts 't=<seconds>' or a bare number, in seconds, milliseconds or
+    microseconds since the epoch.
+    """
+
+    if not header:
+        return 0.0
+
+    value = header.strip()
+    if value.startswith('t='):
+        value = value[2:]
+
+    try:
+        start = float(value)
+    except ValueError:
+        return 0.0
+
+    if start > 1e14:
+        start /= 1e6
+    elif start > 1e11:
+        start /= 1e3
+
+    return max(0.0, (now or time.time()) - start)
+
+
+class AdmissionControl:
+    """Flask extension that puts each request through its class's Gate.
+
+    Install it before the blueprints so it runs ahead of any
+    before_request hook that touches the database.
+    """
+
+    def __init__(self, app=None):
+        self.gates = {}
+        self.routes = {}
+        self.exempt = set()
+        self.shared = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        classes = app.config.get('ADMISSION_CLASSES', DEFAULT_CLASSES)
+        slot_dir = app.config.get('ADMISSION_SLOT_DIR')
+        self.gates = {name: Gate(name, slot_dir=slot_dir, **opts)
+                      for name, opts in classes.items()}
+        self.shared = bool(slot_dir)
+        self.queue_header = app.config.get('ADMISSION_QUEUE_HEADER')
+        self.routes = dict(app.config.get('ADMISSION_ROUTES', DEFAULT_ROUTES))
+        self.exempt = set(app.config.get('ADMISSION_EXEMPT', DEFAULT_EXEMPT))
+
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+        app.extensions['admission'] = self
+
+    def gate_for(self, endpoint):
+        """Return the Gate for `endpoint`, or None if it is exempt."""
+
+        if endpoint is None or endpoint in self.exempt:
+            return None
+        return self.gates[self.routes.get(endpoint, 'default')]
+
+    def stats(self):
+        """Per-class queue depth, in-flight and shed counts."""
+
+        return {name: gate.stats() for name, gate in self.gates.items()}
+
+    def _admit(self):
+        gate = self.gate_for(request.endpoint)
+        if gate is None:
+            return None
+
+        waited = 0.0
+        if self.queue_header:
+            waited = upstream_wait(request.headers.get(self.queue_header))
+
+        token = gate.acquire(waited)
+        if token is None:
+            return ("Service temporarily overloaded, please retry.", 503,
+                    {'Retry-After': str(gate.retry_after)})
+
+        g.admission_slot = (gate, token)
+        return None
+
+    def _release(self, exc):
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            gate, token = slot
+            gate.release(token)
@@ -1,40 +1,164 @@
-import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+# Cold-start timing starts here, so it covers importing Flask, SQLAlchemy
+# and the models as well as create_app itself.
+_IMPORT_START = time.perf_counter()
 
+import logging
+from contextlib import contextmanager
+
+from flask import (
+    Blueprint, Flask, Response, abort, render_template, request, flash,
+    redirect, session, g, current_app, jsonify, stream_with_context)
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from config import get_config
 from forms import UserAddForm, LoginForm, MessageForm, UpdateProfileForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Follows
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# Most ids one bulk follow/unfollow request may name.
+BULK_FOLLOW_LIMIT = 1000
+
+bp = Blueprint('warbler', __name__)
+
+startup_logger = logging.getLogger('warbler.startup')
+
+# Used only while nothing has configured the root logger.
+_startup_fallback = logging.StreamHandler()
+_startup_fallback.setFormatter(logging.Formatter(
+    "[%(asctime)s] %(levelname)s in %(name)s: %(message)s"))
+
+
+##############################################################################
+# App factory
+
+
+@contextmanager
+def _startup_stage(timings, name):
+    """Record how long the body of this `with` block takes in `timings`."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def create_app(config=None):
+    """Build and return a Warbler app.
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    `config` is a profile name from config.CONFIGS ('development',
+    'testing', 'production'), a config class, or None to use the
+    WARBLER_CONFIG environment variable.
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    Debug tooling is only imported when DEBUG_TB_ENABLED is set. Time
+    spent in each startup stage is kept in app.extensions['startup_timing']
+    (seconds, by stage name) and logged when LOG_STARTUP_TIMING is on.
+    The first app built in a process also reports module import time as
+    the 'imports' stage.
+    """
+
+    global _import_seconds
+
+    timings = {}
+    total_start = time.perf_counter()
+
+    if _import_seconds is not None:
+        timings['imports'] = _import_seconds
+        total_start -= _import_seconds
+        _import_seconds = None
+
+    with _startup_stage(timings, 'config'):
+        app = Flask(__name__)
+        if config is None or isinstance(config, str):
+            config = get_config(config)
+        app.config.from_object(config)
+
+        if not app.config['SECRET_KEY']:
+            raise RuntimeError("SECRET_KEY must be set for this profile")
+
+    if app.config['DEBUG_TB_ENABLED']:
+        with _startup_stage(timings, 'debug_toolbar'):
+            from flask_debugtoolbar import DebugToolbarExtension
+            DebugToolbarExtension(app)
+
+    with _startup_stage(timings, 'database'):
+        connect_db(app)
+
+    if app.config['METRICS_ENABLED']:
+        # Before admission control, so shed requests are still counted.
+        with _startup_stage(timings, 'metrics'):
+            from metrics import Metrics, observe_bcrypt
+            from models import BCRYPT_OBSERVERS
+            Metrics(app, db)
+            BCRYPT_OBSERVERS.add(observe_bcrypt)
+
+    if app.config['ADMISSION_ENABLED']:
+        # Registered ahead of the blueprint so shedding happens before
+        # add_user_to_g goes to the database.
+        with _startup_stage(timings, 'admission'):
+            from admission import AdmissionControl
+            AdmissionControl(app)
+
+    if app.config['PROFILER_ENABLED']:
+        # After admission control, so shed requests are never profiled.
+        with _startup_stage(timings, 'profiler'):
+            from profiler import Profiler
+            Profiler(app)
+
+    if app.config['MESSAGE_BATCHING_ENABLED']:
+        with _startup_stage(timings, 'message_batching'):
+            from batching import MessageBatcher
+            MessageBatcher(app, db)
+
+    with _startup_stage(timings, 'blueprints'):
+        from archive import messages_cli
+        from user_data import users_cli
+        app.register_blueprint(bp)
+        app.cli.add_command(messages_cli)
+        app.cli.add_command(users_cli)
+
+    timings['total'] = time.perf_counter() - total_start
+    app.extensions['startup_timing'] = timings
+
+    if app.config['LOG_STARTUP_TIMING']:
+        _log_startup_timing(timings)
+
+    return app
+
+
+def _log_startup_timing(timings):
+    """Log `timings` at INFO, whatever the app's own log level is.
+
+    Records go to the root logger's handlers (gunicorn --log-config,
+    dictConfig). Only when nothing has configured logging is a stderr
+    handler added.
+    """
 
-connect_db(app)
+    startup_logger.setLevel(logging.INFO)
+    if logging.getLogger().hasHandlers():
+        startup_logger.removeHandler(_startup_fallback)
+    else:
+        startup_logger.addHandler(_startup_fallback)
+
+    startup_logger.info(
+        "startup: %s",
+        ", ".join(f"{name}={secs * 1000:.1f}ms"
+                  for name, secs in timings.items()))
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global.
     
     
-    @app.brfore_request will run before each request. The "g" 
+    @bp.before_app_request will run before each request. The "g" 
     object is a global namespace for holding data during a single
     app context. This will set g.user to the user that is signed in
     and it will be accessible to every route.
@@ -60,7 +184,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -96,7 +220,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -116,7 +240,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
     
@@ -129,7 +253,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -146,7 +270,7 @@ def list_users():
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
@@ -163,7 +287,7 @@ def users_show(user_id):
     return render_template('users/show.html', user=user, messages=messages)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -175,7 +299,7 @@ def show_following(user_id):
     return render_template('users/following.html', user=user)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -187,7 +311,7 @@ def users_followers(user_id):
     return render_template('users/followers.html', user=user)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -195,14 +319,15 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    result = Follows.follow(g.user.id, [follow_id])
+    if result[follow_id] == 'not_found':
+        abort(404)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -210,14 +335,46 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.unfollow(g.user.id, [follow_id])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/following/bulk', methods=['POST'])
+def bulk_follow():
+    """Follow or unfollow many users at once (e.g. contact import).
+
+    Takes JSON {"action": "follow" | "unfollow", "ids": [...]} and answers
+    with the status of each id: {"results": {"<id>": "<status>", ...}}.
+    All the writes happen in a single statement.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    ids = data.get('ids')
+
+    if (action not in ('follow', 'unfollow') or not isinstance(ids, list) or
+            not all(type(i) is int for i in ids)):
+        return jsonify(error="Expected an action and a list of user ids."), 400
+
+    if len(ids) > BULK_FOLLOW_LIMIT:
+        return jsonify(
+            error=f"At most {BULK_FOLLOW_LIMIT} ids per request."), 400
+
+    if action == 'follow':
+        results = Follows.follow(g.user.id, ids)
+    else:
+        results = Follows.unfollow(g.user.id, ids)
+    db.session.commit()
+
+    return jsonify(results={str(i): status for i, status in results.items()})
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     if not g.user:
@@ -246,7 +403,34 @@ def profile():
     return render_template('users/edit.html', form=form)
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/export')
+def export_user():
+    """Download all of the current user's data.
+
+    Streams NDJSON, or CSV with ?format=csv, without loading it all.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    from user_data import FORMATS, export_records
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+
+    serialize, mimetype = FORMATS[fmt]
+    # Usernames can hold quotes and non-latin-1 characters; ids can't.
+    filename = f"warbler-{g.user.id}.{fmt}"
+
+    return Response(
+        stream_with_context(serialize(export_records(g.user))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -265,11 +449,16 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
+
+    With message batching on and a threaded server, the insert is
+    group-committed together with other requests' posts. Under a
+    single-threaded worker there is nobody to batch with, so the message
+    is inserted directly.
     """
 
     if not g.user:
@@ -279,24 +468,47 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        batcher = current_app.extensions.get('message_batcher')
+        try:
+            if batcher is not None and request.environ.get('wsgi.multithread'):
+                batcher.post(g.user.id, form.text.data)
+            else:
+                msg = Message(text=form.text.data, user_id=g.user.id)
+                db.session.add(msg)
+                db.session.commit()
+        except TimeoutError:
+            # It may still be committed, so don't invite a second post.
+            flash("Your message is taking a while to post. Check your "
+                  "profile before posting it again.", "warning")
+        except SQLAlchemyError:
+            db.session.rollback()
+            flash("Couldn't post your message, please try again.", "danger")
+            return render_template('messages/new.html', form=form)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
+
+    Messages that have been moved to the cold archive are still shown,
+    without the delete/follow actions.
+    """
 
     msg = Message.query.get(message_id)
+    if msg is None:
+        from archive import archived_message
+        msg = archived_message(message_id)
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -305,6 +517,9 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    if msg is None:
+        abort(404)
+
     db.session.delete(msg)
     db.session.commit()
 
@@ -319,7 +534,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -351,7 +566,7 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
@@ -360,3 +575,7 @@ def add_header(req):
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+# Everything above ran at import; create_app reports it once.
+_import_seconds = time.perf_counter() - _IMPORT_START
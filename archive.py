@@ -0,0 +1,535 @@
+"""Time-partitioned message storage and cold archive.
+
+On Postgres, `flask messages partition` turns `messages` into a table
+declaratively partitioned by month on `timestamp`: messages_pYYYYMM, plus
+messages_default for anything outside the known months. Rows that land in
+messages_default are moved into their month's partition when it is
+created, and archived by month like any other. The ORM model doesn't
+change. Postgres can't enforce a foreign key into a partitioned
+table unless it includes the partition key, so likes.message_id loses its
+FK in the process.
+
+Other databases (SQLite for local testing) keep a single `messages` table
+and treat each calendar month of it as a partition, so the same commands
+work.
+
+`flask messages maintain` (run it daily from cron):
+
+- creates partitions for the next MESSAGE_PARTITIONS_AHEAD months, and
+- moves every month that ended more than MESSAGE_RETENTION_DAYS ago into
+  MESSAGE_ARCHIVE_DIR/messages-YYYY-MM.ndjson.gz, then drops it from the
+  database.
+
+manifest.json in the archive directory records each month's id range.
+messages_show uses it to find archived messages by id. Each archive file
+is a series of gzip members of INDEX_EVERY rows, and a sparse
+<file>.idx lists the first id and byte offset of each member, so a
+lookup only decompresses one member.
+"""
+
+import bisect
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db, Message, User
+
+messages_cli = AppGroup('messages', help="Message partitioning and archive.")
+
+PARTITION_PREFIX = 'messages_p'
+
+STREAM_BATCH = 1000
+
+# Rows per gzip member, i.e. per entry in a file's sparse id index.
+INDEX_EVERY = 1000
+
+
+##############################################################################
+# Months
+
+
+def month_start(when):
+    """First instant of the month containing `when`."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, n):
+    """`month` (a month_start) moved by `n` months."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y%m}"
+
+
+def archive_cutoff(now, retention_days):
+    """Months starting before the returned month can be archived."""
+
+    return month_start(now - timedelta(days=retention_days))
+
+
+##############################################################################
+# Archive files
+
+
+class MessageArchive:
+    """Gzipped NDJSON files of archived messages, one per month."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._manifest = None
+        self._manifest_mtime = None
+        self._indexes = {}
+
+    def manifest(self):
+        """List of {month, file, rows, min_id, max_id}.
+
+        Cached until the manifest file changes.
+        """
+
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            return []
+
+        if mtime != self._manifest_mtime:
+            with open(self.manifest_path) as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+
+        return self._manifest
+
+    def write_month(self, month, rows):
+        """Write `rows` (id, text, timestamp, user_id) as `month`'s file.
+
+        `rows` must come in id order. The file is only added to the
+        manifest once it and its index are fully written.
+        A month archived more than once (late rows) gets extra numbered
+        files rather than overwriting. Returns the number of rows written.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        taken = {e['file'] for e in self.manifest()}
+        filename = f"messages-{month:%Y-%m}.ndjson.gz"
+        part = 1
+        while filename in taken:
+            part += 1
+            filename = f"messages-{month:%Y-%m}-{part}.ndjson.gz"
+        path = os.path.join(self.directory, filename)
+
+        count = 0
+        min_id = max_id = None
+        index = []
+        member = None
+        with open(f"{path}.tmp", 'wb') as raw:
+            for message_id, body, timestamp, user_id in rows:
+                if count % INDEX_EVERY == 0:
+                    # Start a new gzip member that can be read on its own.
+                    if member is not None:
+                        member.close()
+                    index.append([message_id, raw.tell()])
+                    member = gzip.GzipFile(fileobj=raw, mode='wb')
+                member.write(json.dumps({
+                    'id': message_id,
+                    'text': body,
+                    'timestamp': timestamp.isoformat(),
+                    'user_id': user_id,
+                }).encode() + b"\n")
+                count += 1
+                min_id = min(message_id, min_id or message_id)
+                max_id = max(message_id, max_id or message_id)
+            if member is not None:
+                member.close()
+
+        with open(f"{path}.idx.tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(f"{path}.idx.tmp", f"{path}.idx")
+        os.replace(f"{path}.tmp", path)
+
+        entries = list(self.manifest())
+        if count:
+            entries.append({'month': f"{month:%Y-%m}", 'file': filename,
+                            'rows': count, 'min_id': min_id,
+                            'max_id': max_id})
+        else:
+            os.remove(path)
+            os.remove(f"{path}.idx")
+
+        entries.sort(key=lambda e: e['file'])
+        with open(f"{self.manifest_path}.tmp", 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+        self._manifest = entries
+        self._manifest_mtime = os.path.getmtime(self.manifest_path)
+
+        return count
+
+    def find(self, message_id):
+        """Return the archived row for `message_id` as a dict, or None."""
+
+        for entry in self.manifest():
+            if not entry['min_id'] <= message_id <= entry['max_id']:
+                continue
+
+            path = os.path.join(self.directory, entry['file'])
+            with open(path, 'rb') as raw:
+                raw.seek(self._offset(path, message_id))
+                with gzip.GzipFile(fileobj=raw) as f:
+                    for line in f:
+                        row = json.loads(line)
+                        if row['id'] > message_id:
+                            break
+                        if row['id'] == message_id:
+                            row['timestamp'] = datetime.fromisoformat(
+                                row['timestamp'])
+                            return row
+
+        return None
+
+    def rows(self):
+        """Yield every archived row as a dict, one file after another."""
+
+        for entry in self.manifest():
+            path = os.path.join(self.directory, entry['file'])
+            with gzip.open(path, 'rt') as f:
+                for line in f:
+                    row = json.loads(line)
+                    row['timestamp'] = datetime.fromisoformat(
+                        row['timestamp'])
+                    yield row
+
+    def _offset(self, path, message_id):
+        """Offset of the gzip member that would hold `message_id`."""
+
+        if path not in self._indexes:
+            try:
+                with open(f"{path}.idx") as f:
+                    index = json.load(f)
+            except OSError:
+                index = [[0, 0]]
+            self._indexes[path] = ([first for first, _ in index],
+                                   [offset for _, offset in index])
+
+        first_ids, offsets = self._indexes[path]
+        i = bisect.bisect_right(first_ids, message_id) - 1
+        return offsets[max(i, 0)]
+
+
+_archives = {}
+
+
+def get_archive(app=None):
+    """The MessageArchive for `app` (default: current app)."""
+
+    directory = (app or current_app).config['MESSAGE_ARCHIVE_DIR']
+    if directory not in _archives:
+        _archives[directory] = MessageArchive(directory)
+    return _archives[directory]
+
+
+def archived_message(message_id):
+    """Return an archived message as a detached Message, or None.
+
+    The result is never added to the session and has `archived` set;
+    `user` is loaded so the usual templates can render it.
+    """
+
+    row = get_archive().find(message_id)
+    if row is None:
+        return None
+
+    user = User.query.get(row['user_id'])
+    if user is None:
+        return None
+
+    msg = Message(id=row['id'], text=row['text'],
+                  timestamp=row['timestamp'], user_id=row['user_id'])
+    msg.user = user
+    msg.archived = True
+    return msg
+
+
+##############################################################################
+# Partitions
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def is_partitioned(conn):
+    """Is `messages` a partitioned table? (Always False off Postgres.)"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    return bool(conn.execute(text(
+        "SELECT relkind = 'p' FROM pg_class "
+        "WHERE oid = to_regclass('messages')")).scalar())
+
+
+def list_partitions(conn):
+    """Months that currently hold messages, oldest first.
+
+    On Postgres that's every monthly partition plus each month with rows
+    in messages_default.
+    """
+
+    if is_partitioned(conn):
+        names = [row[0] for row in conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass('messages')"))]
+        months = {datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m')
+                  for name in names
+                  if name.startswith(PARTITION_PREFIX)}
+        months.update(row[0] for row in conn.execute(text(
+            "SELECT DISTINCT date_trunc('month', timestamp) "
+            "FROM messages_default")))
+        return sorted(months)
+
+    oldest = conn.execute(
+        text("SELECT MIN(timestamp) FROM messages")).scalar()
+    if oldest is None:
+        return []
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+
+    months = []
+    month = month_start(oldest)
+    while month <= month_start(datetime.utcnow()):
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def partition_exists(conn, month):
+    """Does `month` have its own partition? (Always False off Postgres.)"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"),
+                        {'name': partition_name(month)}).scalar()
+
+
+def create_partition(conn, month):
+    """Create `month`'s partition if it doesn't exist (Postgres only).
+
+    Postgres refuses to attach a partition while messages_default holds
+    rows in its range, so those rows are moved into it first.
+    """
+
+    if partition_exists(conn, month):
+        return
+
+    name = partition_name(month)
+    conn.execute(text(
+        f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS)"))
+    conn.execute(text(
+        f"WITH moved AS ("
+        f"  DELETE FROM messages_default"
+        f"  WHERE timestamp >= :start AND timestamp < :end"
+        f"  RETURNING id, text, timestamp, user_id) "
+        f"INSERT INTO {name} (id, text, timestamp, user_id) "
+        f"SELECT id, text, timestamp, user_id FROM moved"),
+        {'start': month, 'end': add_months(month, 1)})
+    conn.execute(text(
+        f"ALTER TABLE messages ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+        f"TO ('{add_months(month, 1):%Y-%m-%d}')"))
+
+
+def partition_messages(conn, months_ahead):
+    """Convert a plain `messages` table to a monthly partitioned one.
+
+    Runs in the caller's transaction; existing rows are copied over and
+    the id sequence is kept.
+    """
+
+    oldest = conn.execute(
+        text("SELECT MIN(timestamp) FROM messages")).scalar()
+    first = month_start(oldest or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), months_ahead)
+
+    conn.execute(text(
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey"))
+    conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    conn.execute(text("""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)"""))
+    conn.execute(text(
+        "CREATE INDEX ix_messages_user_id_timestamp "
+        "ON messages (user_id, timestamp DESC)"))
+    conn.execute(text(
+        "CREATE TABLE messages_default PARTITION OF messages DEFAULT"))
+
+    month = first
+    while month <= last:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+
+    conn.execute(text(
+        "INSERT INTO messages (id, text, timestamp, user_id) "
+        "SELECT id, text, timestamp, user_id FROM messages_unpartitioned"))
+    conn.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    conn.execute(text("DROP TABLE messages_unpartitioned"))
+
+
+def stream_month(conn, month):
+    """Yield (id, text, timestamp, user_id) for `month` in bounded memory.
+
+    Rows come in id order. On Postgres the range is pruned to the month's
+    partition, or to messages_default if it has none.
+    """
+
+    sql = ("SELECT id, text, timestamp, user_id FROM messages "
+           "WHERE timestamp >= :start AND timestamp < :end ORDER BY id")
+
+    result = conn.execution_options(stream_results=True).execute(
+        text(sql), {'start': month, 'end': add_months(month, 1)})
+
+    while True:
+        rows = result.fetchmany(STREAM_BATCH)
+        if not rows:
+            break
+        for message_id, body, timestamp, user_id in rows:
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            yield message_id, body, timestamp, user_id
+
+
+def lock_month(conn, month):
+    """Block writes to `month`'s rows until the transaction ends.
+
+    Postgres only: takes a SHARE lock on the month's partition, or on
+    whichever table holds it if it has none. Other databases rely on
+    drop_month's `max_id` instead.
+    """
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    if partition_exists(conn, month):
+        table = partition_name(month)
+    elif is_partitioned(conn):
+        table = 'messages_default'
+    else:
+        table = 'messages'
+    conn.execute(text(f"LOCK TABLE {table} IN SHARE MODE"))
+
+
+def drop_month(conn, month, max_id=None):
+    """Remove `month`'s messages from the database.
+
+    Without its own partition, only rows with ids up to `max_id` (if
+    given) are deleted, so rows added after archiving aren't lost.
+    """
+
+    if partition_exists(conn, month):
+        conn.execute(text(f"DROP TABLE {partition_name(month)}"))
+        return
+
+    sql = "DELETE FROM messages WHERE timestamp >= :start AND timestamp < :end"
+    if max_id is not None:
+        sql += " AND id <= :max_id"
+    conn.execute(text(sql), {'start': month, 'end': add_months(month, 1),
+                             'max_id': max_id})
+
+
+def maintain(app, now=None):
+    """Create upcoming partitions and archive expired ones.
+
+    Returns a list of (month, rows archived).
+    """
+
+    now = now or datetime.utcnow()
+    archive = get_archive(app)
+    cutoff = archive_cutoff(now, app.config['MESSAGE_RETENTION_DAYS'])
+    archived = []
+
+    with db.engine.begin() as conn:
+        if is_partitioned(conn):
+            for n in range(app.config['MESSAGE_PARTITIONS_AHEAD'] + 1):
+                create_partition(conn, add_months(month_start(now), n))
+
+    with db.engine.connect() as conn:
+        months = [m for m in list_partitions(conn)
+                  if add_months(m, 1) <= cutoff]
+
+    for month in months:
+        # Stream, write and drop in one transaction, with the month locked
+        # against new rows, so nothing is dropped without being archived.
+        # The rows are only dropped once the file is in the manifest; a
+        # failure after that just archives the month again next run, and
+        # find() returns the first copy.
+        with db.engine.begin() as conn:
+            lock_month(conn, month)
+            rows = _LastId(stream_month(conn, month))
+            count = archive.write_month(month, rows)
+            if rows.last_id is not None or partition_exists(conn, month):
+                drop_month(conn, month, rows.last_id)
+        if count:
+            archived.append((month, count))
+
+    return archived
+
+
+class _LastId:
+    """Iterate over (id, ...) rows, remembering the last id seen."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.last_id = None
+
+    def __iter__(self):
+        for row in self.rows:
+            self.last_id = row[0]
+            yield row
+
+
+##############################################################################
+# CLI
+
+
+@messages_cli.command('partition')
+def partition_command():
+    """Convert `messages` to monthly partitions (Postgres)."""
+
+    if not is_postgres():
+        raise click.ClickException(
+            "Declarative partitioning needs Postgres; other databases use "
+            "calendar months of the plain table.")
+
+    with db.engine.begin() as conn:
+        if is_partitioned(conn):
+            click.echo("messages is already partitioned.")
+            return
+        partition_messages(
+            conn, current_app.config['MESSAGE_PARTITIONS_AHEAD'])
+
+    click.echo("messages is now partitioned by month.")
+
+
+@messages_cli.command('maintain')
+def maintain_command():
+    """Create future partitions and archive expired ones."""
+
+    for month, count in maintain(current_app):
+        click.echo(f"archived {month:%Y-%m}: {count} messages")
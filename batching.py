@@ -0,0 +1,183 @@
+"""Write-behind group commit for new messages.
+
+With MESSAGE_BATCHING_ENABLED, messages_add doesn't insert and commit on
+its own. It hands the post to a MessageBatcher and waits. A background
+thread collects posts from concurrent requests until it has
+MESSAGE_BATCH_SIZE of them, or until the oldest has waited
+MESSAGE_BATCH_DELAY seconds. It then inserts them all with one multi-row
+INSERT in one transaction.
+
+Each caller still gets back its own message id. If the batch fails,
+every post in it is retried alone, so one bad row doesn't take the
+others with it; each caller gets its own error. If flushing fails in
+some other way, every post in that batch gets the error and the thread
+carries on with the next batch.
+
+Batching is per process, so it only helps threaded workers (gunicorn
+--threads, gthread, or the dev server). messages_add skips the batcher
+when the WSGI server says it isn't multithreaded. A sync worker has no
+other posts to batch with, and would only wait MESSAGE_BATCH_DELAY.
+
+Batch sizes and the latency batching adds are recorded in
+message_batch_size and message_batch_wait_seconds.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from metrics import Histogram
+from models import Message
+
+BATCH_SIZES = Histogram(
+    'message_batch_size', 'Messages inserted per group commit.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+BATCH_WAIT_SECONDS = Histogram(
+    'message_batch_wait_seconds',
+    'Time from handing a message to the batcher until it is committed.',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0))
+
+logger = logging.getLogger('warbler.batching')
+
+
+class _Pending:
+    """One post waiting for its batch to be committed."""
+
+    def __init__(self, user_id, text):
+        self.user_id = user_id
+        self.text = text
+        self.timestamp = datetime.utcnow()
+        self.submitted = time.perf_counter()
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+
+    def row(self):
+        return {'text': self.text, 'timestamp': self.timestamp,
+                'user_id': self.user_id}
+
+
+class MessageBatcher:
+    """Flask extension that group-commits new messages."""
+
+    def __init__(self, app=None, db=None):
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.batch_size = app.config.get('MESSAGE_BATCH_SIZE', 50)
+        self.max_delay = app.config.get('MESSAGE_BATCH_DELAY', 0.005)
+        self.timeout = app.config.get('MESSAGE_BATCH_TIMEOUT', 5.0)
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._pid = None
+        self._thread = None
+
+        app.extensions['message_batcher'] = self
+
+    def post(self, user_id, text):
+        """Add a message for `user_id` and return its id once committed.
+
+        Raises whatever error inserting it raised, or TimeoutError if it
+        wasn't committed within MESSAGE_BATCH_TIMEOUT seconds (in which
+        case it may still be committed later).
+        """
+
+        item = _Pending(user_id, text)
+
+        with self._cond:
+            self._ensure_flusher()
+            self._queue.append(item)
+            self._cond.notify()
+
+        if not item.done.wait(self.timeout):
+            raise TimeoutError("Message was not committed in time")
+        if item.error is not None:
+            raise item.error
+        return item.id
+
+    def _ensure_flusher(self):
+        # Threads don't survive fork, so each worker starts its own.
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='warbler-message-batcher')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.exception("Flushing %d messages failed", len(batch))
+                for item in batch:
+                    if item.id is None and item.error is None:
+                        item.error = e
+            finally:
+                # Whatever happened, nobody is left waiting on this batch.
+                for item in batch:
+                    item.done.set()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+
+            deadline = self._queue[0].submitted + self.max_delay
+            while len(self._queue) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._queue[:self.batch_size]
+            del self._queue[:self.batch_size]
+            return batch
+
+    def _flush(self, batch):
+        engine = self.db.get_engine(self.app)
+
+        try:
+            with engine.begin() as conn:
+                self._insert(conn, batch)
+        except Exception:
+            for item in batch:
+                item.id = None
+                try:
+                    with engine.begin() as conn:
+                        self._insert(conn, [item])
+                except Exception as e:
+                    item.error = e
+
+        now = time.perf_counter()
+        BATCH_SIZES.observe(len(batch))
+        for item in batch:
+            BATCH_WAIT_SECONDS.observe(now - item.submitted)
+
+    def _insert(self, conn, items):
+        table = Message.__table__
+
+        if conn.dialect.name == 'postgresql':
+            # Take the ids first so each row's id is known without relying
+            # on the order RETURNING comes back in.
+            ids = [i for i, in conn.execute(
+                text("SELECT nextval('messages_id_seq') "
+                     "FROM generate_series(1, :n)"), {'n': len(items)})]
+            conn.execute(table.insert().values(
+                [{'id': i, **item.row()} for i, item in zip(ids, items)]))
+            for i, item in zip(ids, items):
+                item.id = i
+        else:
+            # Other databases (local testing): still one transaction.
+            for item in items:
+                result = conn.execute(table.insert().values(item.row()))
+                item.id = result.inserted_primary_key[0]
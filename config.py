@@ -0,0 +1,122 @@
+"""Configuration profiles for Warbler.
+
+Pick one by name when building the app:
+
+    create_app('production')
+
+or set WARBLER_CONFIG in the environment (defaults to 'development').
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgresql:///warbler')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Debug toolbar is only imported and installed when this is on.
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Serve /metrics; set METRICS_MULTIPROC_DIR to a shared directory when
+    # running several pre-forked workers so their totals are combined.
+    # Only METRICS_ALLOWED_IPS, or scrapers sending the bearer token, may
+    # read it.
+    METRICS_ENABLED = True
+    METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR')
+    METRICS_FLUSH_INTERVAL = 1.0
+    METRICS_ALLOWED_IPS = ('127.0.0.0/8', '::1')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Per-route concurrency limits and load shedding (see admission.py).
+    # Sync (one request per process) workers need ADMISSION_SLOT_DIR so
+    # the limits are shared; otherwise each worker only limits itself.
+    ADMISSION_ENABLED = False
+    ADMISSION_SLOT_DIR = None
+    ADMISSION_QUEUE_HEADER = None
+
+    # Sampling profiler for live requests (see profiler.py). Requests are
+    # profiled when they send X-Warbler-Profile: <PROFILER_TOKEN>, or at
+    # random with probability PROFILER_SAMPLE_RATE.
+    PROFILER_ENABLED = False
+    PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')
+    PROFILER_SAMPLE_RATE = 0.0
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MIN_INTERVAL = 1.0
+    PROFILER_MAX_FILES = 100
+    PROFILER_DIR = os.environ.get('PROFILER_DIR', 'profiles')
+
+    # Message partitions and cold archive (see archive.py).
+    MESSAGE_ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR', 'archive')
+    MESSAGE_RETENTION_DAYS = 365
+    MESSAGE_PARTITIONS_AHEAD = 3
+
+    # Group-commit new messages under burst load (see batching.py). Only
+    # useful with threaded workers; sync workers post directly.
+    MESSAGE_BATCHING_ENABLED = False
+    MESSAGE_BATCH_SIZE = 50
+    MESSAGE_BATCH_DELAY = 0.005
+    MESSAGE_BATCH_TIMEOUT = 5.0
+
+    # Log per-stage startup timing (also kept in app.extensions).
+    LOG_STARTUP_TIMING = True
+
+
+class DevelopmentConfig(Config):
+    """Local development: SQL echo and the debug toolbar."""
+
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+
+
+class TestingConfig(Config):
+    """Unit tests: separate database, no CSRF."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///warbler-test')
+    WTF_CSRF_ENABLED = False
+    LOG_STARTUP_TIMING = False
+    METRICS_ENABLED = False
+
+
+class ProductionConfig(Config):
+    """Autoscaled workers: no debug machinery at all."""
+
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    ADMISSION_ENABLED = True
+    ADMISSION_SLOT_DIR = os.environ.get(
+        'ADMISSION_SLOT_DIR',
+        os.path.join(tempfile.gettempdir(), 'warbler-admission'))
+    ADMISSION_QUEUE_HEADER = 'X-Request-Start'
+    # Behind the proxy every request comes from its address, so an IP
+    # allowlist would let anyone in; scrapers must send METRICS_TOKEN.
+    METRICS_ALLOWED_IPS = ()
+    PROFILER_ENABLED = True
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """Return the config class for profile `name`.
+
+    Falls back to WARBLER_CONFIG, then 'development'. Raises KeyError
+    for an unknown profile name.
+    """
+
+    name = name or os.environ.get('WARBLER_CONFIG', 'development')
+    return CONFIGS[name]
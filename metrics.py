@@ -0,0 +1,640 @@
+"""Prometheus-style metrics for Warbler.
+
+Counters and histograms are kept in per-thread shards. Each thread only
+writes to its own dict, so recording a value takes no lock. The shards are
+only merged when /metrics is scraped. Shards of threads that have exited
+are folded into one retired total, so thread-per-request servers don't
+grow without bound.
+
+When METRICS_MULTIPROC_DIR is set, each pre-forked worker also dumps its
+totals to <dir>/<pid>-<start ms>.json from time to time. Whichever worker
+gets the scrape adds the other workers' files to its own live values.
+Files of workers that have exited are merged into <dir>/aggregate.json
+and removed, so counters never go backwards and a reused pid never
+overwrites an old worker's totals.
+
+Pool gauges are per worker and labelled with pid. Admission gauges are
+host-wide when ADMISSION_SLOT_DIR is set, and per worker (with pid)
+otherwise.
+
+/metrics is only served to METRICS_ALLOWED_IPS, or to requests that send
+"Authorization: Bearer <METRICS_TOKEN>". Behind a reverse proxy every
+request comes from the proxy's address, so production allows no IPs and
+needs the token.
+
+Other layers can add their own samples with Registry.register_collector,
+or report a cache with register_cache:
+
+    metrics.REGISTRY.register_cache('timeline', lambda: (hits, misses))
+"""
+
+import atexit
+import bisect
+import fcntl
+import glob
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import (
+    Response, abort, current_app, g, has_request_context, request)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75,
+                   1.0, 2.5, 5.0, 7.5, 10.0)
+
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+AGGREGATE_FILE = 'aggregate.json'
+
+# Fold dead threads' shards once there are this many shards.
+FOLD_SHARDS_AT = 64
+
+
+class Registry:
+    """Holds metric definitions, per-thread values and collectors."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._reset_shards()
+
+        if hasattr(os, 'register_at_fork'):
+            # Values counted in the master before fork belong to the
+            # master; children start from zero.
+            os.register_at_fork(after_in_child=self._reset_shards)
+
+    def _reset_shards(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._fold_at = FOLD_SHARDS_AT
+        # Unique even if the OS hands this pid out again later.
+        self.process_id = f"{os.getpid()}-{int(time.time() * 1000)}"
+
+    def shard(self):
+        """Return this thread's value dict, creating it on first use."""
+
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+                if len(self._shards) >= self._fold_at:
+                    self._fold_dead_shards()
+                    self._fold_at = max(FOLD_SHARDS_AT,
+                                        2 * len(self._shards))
+            self._local.values = values
+            return values
+
+    def _fold_dead_shards(self):
+        # Call with self._lock held. A dead thread never writes again, so
+        # its shard can be merged into the retired total and let go.
+        live = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                for key, value in values.items():
+                    _merge_value(self._retired, key, value)
+        self._shards = live
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collector):
+        """Add `collector`, called at scrape time.
+
+        It must return an iterable of (name, type, help, samples), where
+        samples is a list of (labels dict, value).
+        """
+
+        self.collectors.append(collector)
+        return collector
+
+    def register_cache(self, name, stats):
+        """Report hits, misses and hit ratio for cache `name`.
+
+        `stats` is a callable returning (hits, misses) totals.
+        """
+
+        def collect():
+            hits, misses = stats()
+            lookups = hits + misses
+            labels = {'cache': name}
+            return [
+                ('cache_hits_total', 'counter', 'Cache hits.',
+                 [(labels, hits)]),
+                ('cache_misses_total', 'counter', 'Cache misses.',
+                 [(labels, misses)]),
+                ('cache_hit_ratio', 'gauge', 'Cache hits / lookups.',
+                 [(labels, hits / lookups if lookups else 0.0)]),
+            ]
+
+        return self.register_collector(collect)
+
+    def values(self):
+        """Merge every thread's shard into one {key: value} dict."""
+
+        with self._lock:
+            self._fold_dead_shards()
+            shards = [values for _, values in self._shards]
+            merged = {}
+            for key, value in self._retired.items():
+                _merge_value(merged, key, value)
+
+        for shard in shards:
+            for key, value in shard.copy().items():
+                _merge_value(merged, key, value)
+        return merged
+
+    def dump(self, path):
+        """Atomically write this process's totals to `path` as JSON."""
+
+        _write_json(path, [[name, list(labels), value]
+                           for (name, labels), value in self.values().items()])
+
+    def expose(self, multiproc_dir=None, collectors=()):
+        """Render everything in Prometheus text exposition format.
+
+        `collectors` are extra app-specific collectors to run along with
+        the registered ones.
+        """
+
+        merged = self.values()
+
+        if multiproc_dir:
+            folded = self.compact(multiproc_dir)
+            own = f"{self.process_id}.json"
+            for path in glob.glob(os.path.join(multiproc_dir, '*.json')):
+                name = os.path.basename(path)
+                if name == own or name in folded:
+                    continue
+                for key, value in _read_dump(path):
+                    _merge_value(merged, key, value)
+
+        by_name = {}
+        for (name, labels), value in merged.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render(sorted(by_name.get(name, []))))
+
+        for collector in [*self.collectors, *collectors]:
+            for name, kind, doc, samples in collector():
+                lines.append(f"# HELP {name} {doc}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def compact(self, multiproc_dir):
+        """Merge dead workers' dumps into the aggregate file.
+
+        Returns the names of worker files whose totals are already in the
+        aggregate, so callers can skip them.
+        """
+
+        aggregate_path = os.path.join(multiproc_dir, AGGREGATE_FILE)
+        lock_path = os.path.join(multiproc_dir, 'aggregate.lock')
+
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(aggregate_path) as f:
+                    aggregate = json.load(f)
+            except (OSError, ValueError):
+                aggregate = {'folded': [], 'values': []}
+
+            totals = {}
+            for name, labels, value in aggregate['values']:
+                _merge_value(totals, (name, tuple(labels)), value)
+            folded = {name for name in aggregate['folded']
+                      if os.path.exists(os.path.join(multiproc_dir, name))}
+
+            dead = []
+            for path in glob.glob(os.path.join(multiproc_dir, '*.json')):
+                name = os.path.basename(path)
+                if (name == AGGREGATE_FILE or name in folded or
+                        not _worker_exited(name)):
+                    continue
+                for key, value in _read_dump(path):
+                    _merge_value(totals, key, value)
+                dead.append(name)
+
+            if dead or len(folded) != len(aggregate['folded']):
+                # Record which files are in the aggregate before deleting
+                # them, so a crash in between can't count them twice.
+                folded.update(dead)
+                _write_json(aggregate_path, {
+                    'folded': sorted(folded),
+                    'values': [[name, list(labels), value]
+                               for (name, labels), value in totals.items()],
+                })
+                for name in dead:
+                    os.remove(os.path.join(multiproc_dir, name))
+
+        return folded
+
+
+def _worker_exited(filename):
+    """Is the worker that wrote `<pid>-<start>.json` gone?"""
+
+    try:
+        pid = int(filename.split('-', 1)[0])
+    except ValueError:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _read_dump(path):
+    """Yield (key, value) from a worker dump or the aggregate file."""
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if isinstance(data, dict):
+        data = data['values']
+    for name, labels, value in data:
+        yield (name, tuple(labels)), value
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _merge_value(merged, key, value):
+    if isinstance(value, list):
+        current = merged.get(key)
+        if current is None:
+            merged[key] = list(value)
+        else:
+            merged[key] = [a + b for a, b in zip(current, value)]
+    else:
+        merged[key] = merged.get(key, 0) + value
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\')
+            .replace('\n', r'\n').replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def _key(self, labels):
+        return (self.name, tuple(str(labels[n]) for n in self.labelnames))
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        shard = self.registry.shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    def render(self, samples):
+        lines = self._header()
+        for labels, value in samples:
+            labels = dict(zip(self.labelnames, labels))
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram(Counter):
+    """Histogram with fixed upper bounds, optionally split by labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        shard = self.registry.shard()
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the running sum.
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of this `with` block takes."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, samples):
+        lines = self._header()
+        for labels, counts in samples:
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels({**labels, 'le': bound})}"
+                             f" {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)}"
+                         f" {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)}"
+                         f" {cumulative}")
+        return lines
+
+
+REGISTRY = Registry()
+
+REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests by endpoint, method and status.',
+    ['endpoint', 'method', 'status'])
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by endpoint.',
+    ['endpoint'])
+
+REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries', 'DB queries issued per request.',
+    ['endpoint'], buckets=COUNT_BUCKETS)
+
+REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Time spent in DB queries per request.',
+    ['endpoint'])
+
+DB_QUERY_SECONDS = Histogram(
+    'db_query_duration_seconds', 'Latency of individual DB queries.')
+
+POOL_CHECKOUTS = Counter(
+    'db_pool_checkouts_total', 'Connections checked out of the pool.')
+
+POOL_CONNECTS = Counter(
+    'db_pool_connects_total', 'New DB connections opened by the pool.')
+
+POOL_HOLD_SECONDS = Histogram(
+    'db_pool_hold_seconds', 'How long a connection stays checked out.')
+
+BCRYPT_SECONDS = Histogram(
+    'bcrypt_duration_seconds', 'Time spent hashing/checking passwords.',
+    ['op'], buckets=(.01, .025, .05, .1, .25, .5, 1.0, 2.5))
+
+
+##############################################################################
+# SQLAlchemy hooks
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # Keyed by statement so a failed one's start can be found again in
+    # _handle_error.
+    starts = conn.info.setdefault('metrics_query_start', {})
+    starts[_query_key(cursor, context)] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _finish_query(conn, _query_key(cursor, context))
+
+
+def _handle_error(context):
+    # Failed statements never reach after_cursor_execute; time them here
+    # so they're counted and their start doesn't linger in conn.info.
+    if context.connection is not None:
+        _finish_query(context.connection, _query_key(
+            context.cursor, context.execution_context))
+
+
+def _query_key(cursor, context):
+    # handle_error only gets the cursor when there's no execution context.
+    return id(context) if context is not None else id(cursor)
+
+
+def _finish_query(conn, key):
+    start = conn.info.get('metrics_query_start', {}).pop(key, None)
+    if start is None:
+        return
+
+    elapsed = time.perf_counter() - start
+    DB_QUERY_SECONDS.observe(elapsed)
+
+    if has_request_context() and 'metrics_db_queries' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_seconds += elapsed
+
+
+def _on_checkout(dbapi_conn, record, proxy):
+    POOL_CHECKOUTS.inc()
+    record.info['metrics_checkout_time'] = time.perf_counter()
+
+
+def _on_checkin(dbapi_conn, record):
+    start = record.info.pop('metrics_checkout_time', None)
+    if start is not None:
+        POOL_HOLD_SECONDS.observe(time.perf_counter() - start)
+
+
+def _on_connect(dbapi_conn, record):
+    POOL_CONNECTS.inc()
+
+
+def observe_bcrypt(op, seconds):
+    """models.BCRYPT_OBSERVERS hook."""
+
+    BCRYPT_SECONDS.observe(seconds, op=op)
+
+
+_SQLALCHEMY_LISTENERS = [
+    (Engine, 'before_cursor_execute', _before_cursor_execute),
+    (Engine, 'after_cursor_execute', _after_cursor_execute),
+    (Engine, 'handle_error', _handle_error),
+    (Pool, 'checkout', _on_checkout),
+    (Pool, 'checkin', _on_checkin),
+    (Pool, 'connect', _on_connect),
+]
+
+
+##############################################################################
+# Flask extension
+
+
+class Metrics:
+    """Record per-request metrics and serve them from /metrics."""
+
+    def __init__(self, app=None, db=None, registry=None):
+        self.registry = registry or REGISTRY
+        self.db = db
+        self._last_flush = 0.0
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        self.db = db or self.db
+        self.multiproc_dir = app.config.get('METRICS_MULTIPROC_DIR')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 1.0)
+        self.token = app.config.get('METRICS_TOKEN')
+        self.allowed_networks = [
+            ipaddress.ip_network(net)
+            for net in app.config.get('METRICS_ALLOWED_IPS', ())]
+
+        for target, name, fn in _SQLALCHEMY_LISTENERS:
+            if not event.contains(target, name, fn):
+                event.listen(target, name, fn)
+
+        self.collectors = [self._collect_admission]
+        if self.db is not None:
+            self.collectors.append(self._collect_pool)
+
+        if self.multiproc_dir:
+            os.makedirs(self.multiproc_dir, exist_ok=True)
+            atexit.register(self.flush)
+
+        # Runs before admission control, so shed requests are timed too.
+        app.before_request(self._start)
+        app.after_request(self._record)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        app.extensions['metrics'] = self
+
+    def flush(self):
+        """Write this worker's totals to the multiprocess directory."""
+
+        if self.multiproc_dir:
+            self.registry.dump(os.path.join(
+                self.multiproc_dir, f"{self.registry.process_id}.json"))
+            self._last_flush = time.monotonic()
+
+    def allowed(self):
+        """May the current request read /metrics?"""
+
+        if self.token:
+            expected = f"Bearer {self.token}".encode()
+            given = request.headers.get('Authorization', '')
+            if hmac.compare_digest(given.encode('latin-1'), expected):
+                return True
+
+        try:
+            addr = ipaddress.ip_address(request.remote_addr)
+        except ValueError:
+            return False
+        return any(addr in net for net in self.allowed_networks)
+
+    def view(self):
+        """Serve all metrics in Prometheus text format."""
+
+        if not self.allowed():
+            abort(403)
+
+        body = self.registry.expose(self.multiproc_dir, self.collectors)
+        return Response(body, mimetype=CONTENT_TYPE)
+
+    def _start(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_db_queries = 0
+        g.metrics_db_seconds = 0.0
+
+    def _record(self, response):
+        self._observe(response.status_code)
+        return response
+
+    def _teardown(self, exc):
+        # Only still set if after_request never ran (unhandled error).
+        if 'metrics_start' in g:
+            self._observe(500)
+
+        if (self.multiproc_dir and
+                time.monotonic() - self._last_flush > self.flush_interval):
+            self.flush()
+
+    def _observe(self, status):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+
+        endpoint = request.endpoint or 'none'
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUEST_DB_QUERIES.observe(g.metrics_db_queries, endpoint=endpoint)
+        REQUEST_DB_SECONDS.observe(g.metrics_db_seconds, endpoint=endpoint)
+
+    def _collect_pool(self):
+        pool = self.db.engine.pool
+        labels = {'pid': os.getpid()}
+        samples = []
+        for name, attr in (('db_pool_size', 'size'),
+                           ('db_pool_checked_out', 'checkedout'),
+                           ('db_pool_overflow', 'overflow')):
+            fn = getattr(pool, attr, None)
+            if fn is not None:
+                samples.append((name, 'gauge', f"Pool {attr}() by worker.",
+                                [(labels, fn())]))
+        return samples
+
+    def _collect_admission(self):
+        admission = current_app.extensions.get('admission')
+        if admission is None:
+            return []
+
+        # With shared slots every worker sees the same host-wide numbers,
+        # so a pid label would only make them add up wrong.
+        labels = {} if admission.shared else {'pid': os.getpid()}
+        stats = admission.stats()
+        return [
+            (name, kind, doc,
+             [({'class': cls, **labels}, s[field])
+              for cls, s in stats.items()])
+            for name, field, kind, doc in (
+                ('admission_in_flight', 'in_flight', 'gauge',
+                 'Requests holding a slot.'),
+                ('admission_queue_depth', 'queued', 'gauge',
+                 'Requests waiting for a slot.'),
+            )
+        ]
@@ -1,5 +1,7 @@
 """SQLAlchemy models for Warbler."""
 
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
@@ -8,6 +10,21 @@ from flask_sqlalchemy import SQLAlchemy
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Called as fn(op, seconds) after each bcrypt hash or check. Metrics adds
+# itself here when it's enabled.
+BCRYPT_OBSERVERS = set()
+
+
+@contextmanager
+def _bcrypt_timer(op):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for observer in BCRYPT_OBSERVERS:
+            observer(op, elapsed)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +43,93 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # On Postgres, one statement checks which ids exist, inserts the new
+    # follows and reports which rows it actually inserted.
+    FOLLOW_SQL = db.text("""
+        WITH targets AS (
+            SELECT id FROM users WHERE id = ANY(:ids)
+        ), inserted AS (
+            INSERT INTO follows (user_following_id, user_being_followed_id)
+            SELECT :user_id, id FROM targets WHERE id <> :user_id
+            ON CONFLICT DO NOTHING
+            RETURNING user_being_followed_id
+        )
+        SELECT targets.id, inserted.user_being_followed_id IS NOT NULL
+        FROM targets
+        LEFT JOIN inserted ON inserted.user_being_followed_id = targets.id
+    """)
+
+    @classmethod
+    def follow(cls, user_id, ids):
+        """Have user `user_id` follow every user in `ids`.
+
+        Writes without loading anyone's following collection; the caller
+        commits. Returns {id: status}, status being 'followed',
+        'already_following', 'self' or 'not_found'.
+        """
+
+        ids = list(dict.fromkeys(ids))
+        statuses = dict.fromkeys(ids, 'not_found')
+
+        if db.engine.dialect.name == 'postgresql':
+            rows = db.session.execute(
+                cls.FOLLOW_SQL, {'user_id': user_id, 'ids': ids})
+            for target_id, inserted in rows:
+                if inserted:
+                    statuses[target_id] = 'followed'
+                elif target_id == user_id:
+                    statuses[target_id] = 'self'
+                else:
+                    statuses[target_id] = 'already_following'
+            return statuses
+
+        # Other databases (local testing): same result, more round-trips.
+        existing = {i for i, in db.session.query(User.id)
+                    .filter(User.id.in_(ids))}
+        already = {i for i, in db.session.query(cls.user_being_followed_id)
+                   .filter(cls.user_following_id == user_id,
+                           cls.user_being_followed_id.in_(existing))}
+        new = existing - already - {user_id}
+
+        if new:
+            db.session.execute(cls.__table__.insert(), [
+                {'user_following_id': user_id, 'user_being_followed_id': i}
+                for i in new])
+
+        for i in existing:
+            statuses[i] = ('followed' if i in new else
+                           'self' if i == user_id else 'already_following')
+        return statuses
+
+    @classmethod
+    def unfollow(cls, user_id, ids):
+        """Have user `user_id` stop following every user in `ids`.
+
+        A single DELETE; the caller commits. Returns {id: status}, status
+        being 'unfollowed' or 'not_following'.
+        """
+
+        ids = list(dict.fromkeys(ids))
+        statuses = dict.fromkeys(ids, 'not_following')
+
+        table = cls.__table__
+        delete = table.delete().where(
+            (table.c.user_following_id == user_id) &
+            table.c.user_being_followed_id.in_(ids))
+
+        if db.engine.dialect.name == 'postgresql':
+            removed = [i for i, in db.session.execute(
+                delete.returning(table.c.user_being_followed_id))]
+        else:
+            removed = [i for i, in db.session.query(cls.user_being_followed_id)
+                       .filter(cls.user_following_id == user_id,
+                               cls.user_being_followed_id.in_(ids))]
+            db.session.execute(delete)
+
+        for i in removed:
+            statuses[i] = 'unfollowed'
+        return statuses
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -137,7 +241,9 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with _bcrypt_timer('hash'):
+            hashed = bcrypt.generate_password_hash(password)
+        hashed_pwd = hashed.decode('UTF-8')
 
         user = User(
             username=username,
@@ -163,7 +269,8 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with _bcrypt_timer('check'):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -188,7 +295,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +306,10 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # Set on messages read back from the cold archive (see archive.py);
+    # they can be shown but not changed.
+    archived = False
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
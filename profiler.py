@@ -0,0 +1,263 @@
+"""On-demand sampling profiler for live Warbler requests.
+
+This is what we use instead of the debug toolbar in production. A request
+is profiled when either
+
+- it sends an X-Warbler-Profile header equal to PROFILER_TOKEN (admins
+  only, since only they know the token), or
+- it is randomly picked, with probability PROFILER_SAMPLE_RATE.
+
+While the request runs (view and template render), a background thread
+looks at the request thread's stack every PROFILER_INTERVAL seconds. Only
+one request per process is profiled at a time, and a new profile can't
+start less than PROFILER_MIN_INTERVAL seconds after the last one.
+
+Each profile is written to PROFILER_DIR as a pair of files. Requests
+profiled because of the token get the profile's name back in the
+X-Warbler-Profile response header; randomly sampled ones don't.
+
+    <name>.folded   collapsed stacks, one "a;b;c count" line per stack,
+                    ready for flamegraph.pl / speedscope
+    <name>.json     endpoint, wall time, SQL time and query count
+
+Samples taken while the request thread is inside a DB call end in a
+"[sql]" frame, so SQL time shows up as its own part of the flamegraph.
+Only the newest PROFILER_MAX_FILES profiles are kept. A profile that
+can't be written is logged to the warbler.profiler logger; the request
+itself is served as usual.
+"""
+
+import glob
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HEADER = 'X-Warbler-Profile'
+
+logger = logging.getLogger('warbler.profiler')
+
+# Sampler for the request being profiled in this process, if any.
+_active = None
+
+
+class Sampler:
+    """Collects stack samples of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval, root, trigger=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.trigger = trigger
+        self.stacks = Counter()
+        self.in_sql = False
+        self.sql_seconds = 0.0
+        self.sql_queries = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='warbler-profiler')
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:"
+                             f"{code.co_name}".replace(';', ':'))
+                frame = frame.f_back
+
+            names.append(self.root)
+            names.reverse()
+            if self.in_sql:
+                names.append('[sql]')
+            self.stacks[';'.join(names)] += 1
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    sampler = _active_sampler()
+    if sampler is not None:
+        sampler.in_sql = True
+        conn.info['profiler_query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info.pop('profiler_query_start', None)
+    sampler = _active_sampler()
+    if sampler is not None and start is not None:
+        sampler.in_sql = False
+        sampler.sql_seconds += time.perf_counter() - start
+        sampler.sql_queries += 1
+
+
+def _handle_error(context):
+    # A failed statement skips after_cursor_execute; leave SQL here too, or
+    # every later sample would be tagged [sql].
+    if context.connection is not None:
+        _after_cursor_execute(context.connection, context.cursor, None, None,
+                              context.execution_context, False)
+
+
+def _active_sampler():
+    """Return the active sampler if it is watching the calling thread."""
+
+    sampler = _active
+    if sampler is not None and sampler.thread_id == threading.get_ident():
+        return sampler
+    return None
+
+
+class Profiler:
+    """Flask extension that profiles selected requests."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.token = app.config.get('PROFILER_TOKEN')
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+        self.interval = app.config.get('PROFILER_INTERVAL', 0.005)
+        self.min_interval = app.config.get('PROFILER_MIN_INTERVAL', 1.0)
+        self.max_files = app.config.get('PROFILER_MAX_FILES', 100)
+        self.directory = app.config.get('PROFILER_DIR', 'profiles')
+
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+
+        for name, fn in (('before_cursor_execute', _before_cursor_execute),
+                         ('after_cursor_execute', _after_cursor_execute),
+                         ('handle_error', _handle_error)):
+            if not event.contains(Engine, name, fn):
+                event.listen(Engine, name, fn)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        app.extensions['profiler'] = self
+
+    def wanted(self):
+        """Why to profile the current request: 'token', 'sample' or None."""
+
+        header = request.headers.get(HEADER)
+        if header is not None:
+            # Header values are latin-1; compare bytes so a non-ASCII
+            # header is just a mismatch, not a TypeError.
+            if self.token and hmac.compare_digest(header.encode('latin-1'),
+                                                  self.token.encode()):
+                return 'token'
+            return None
+
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def _start(self):
+        global _active
+
+        trigger = self.wanted()
+        if trigger is None or not self._lock.acquire(blocking=False):
+            return
+
+        now = time.monotonic()
+        if now < self._next_allowed:
+            self._lock.release()
+            return
+        self._next_allowed = now + self.min_interval
+
+        sampler = Sampler(threading.get_ident(), self.interval,
+                          request.endpoint or 'none', trigger)
+        _active = sampler
+        g.profiler_sampler = sampler
+        sampler.start()
+
+    def _finish(self, response):
+        sampler = g.get('profiler_sampler')
+        name = self._stop()
+        if name is not None and sampler.trigger == 'token':
+            response.headers[HEADER] = name
+        return response
+
+    def _teardown(self, exc):
+        self._stop()
+
+    def _stop(self):
+        global _active
+
+        sampler = g.pop('profiler_sampler', None)
+        if sampler is None:
+            return None
+
+        try:
+            sampler.stop()
+            return self._save(sampler)
+        except Exception:
+            # Profiling must never fail the request it is watching, e.g.
+            # when PROFILER_DIR is read-only.
+            logger.exception("Saving profile of %s failed", sampler.root)
+            return None
+        finally:
+            _active = None
+            self._lock.release()
+
+    def _save(self, sampler):
+        """Write the profile files and prune old ones; return their name."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{sampler.root}"
+                f"-{os.getpid()}-{random.randrange(1 << 16):04x}")
+        path = os.path.join(self.directory, name)
+
+        with open(f"{path}.folded", 'w') as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        with open(f"{path}.json", 'w') as f:
+            json.dump({
+                'endpoint': sampler.root,
+                'method': request.method,
+                'path': request.path,
+                'seconds': sampler.duration,
+                'sql_seconds': sampler.sql_seconds,
+                'sql_queries': sampler.sql_queries,
+                'samples': sum(sampler.stacks.values()),
+                'interval': self.interval,
+                'trigger': sampler.trigger,
+            }, f)
+
+        self._prune()
+        return name
+
+    def _prune(self):
+        profiles = sorted(glob.glob(os.path.join(self.directory, '*.json')),
+                          key=os.path.getmtime)
+        for old in profiles[:max(len(profiles) - self.max_files, 0)]:
+            base = old[:-len('.json')]
+            for path in (f"{base}.json", f"{base}.folded"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
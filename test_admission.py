@@ -0,0 +1,243 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from admission import Gate, AdmissionControl, FileSlots, upstream_wait
+from app import create_app
+from config import TestingConfig
+
+
+class AdmissionConfig(TestingConfig):
+    """Testing profile with admission control and metrics on."""
+
+    ADMISSION_ENABLED = True
+    ADMISSION_CLASSES = {
+        'default': {'limit': 1, 'max_queue': 0, 'max_wait': 0,
+                    'retry_after': 7},
+    }
+    ADMISSION_ROUTES = {}
+    ADMISSION_QUEUE_HEADER = 'X-Request-Start'
+    METRICS_ENABLED = True
+
+
+class GateTestCase(TestCase):
+    """Test concurrency limits and shedding on a single Gate."""
+
+    def test_sheds_when_queue_deadline_passes(self):
+        """A request that can't get a slot in time is shed."""
+
+        gate = Gate('write', limit=1, max_queue=1, max_wait=0.01,
+                    retry_after=1)
+
+        token = gate.acquire()
+        self.assertIsNotNone(token)
+        self.assertIsNone(gate.acquire())
+
+        stats = gate.stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['admitted'], 1)
+        self.assertEqual(stats['shed'], 1)
+        self.assertEqual(stats['queued'], 0)
+
+        gate.release(token)
+        self.assertIsNotNone(gate.acquire())
+
+    def test_sheds_immediately_when_queue_full(self):
+        """With no queue room, a request is shed without waiting."""
+
+        gate = Gate('expensive', limit=1, max_queue=0, max_wait=60,
+                    retry_after=2)
+
+        self.assertIsNotNone(gate.acquire())
+        self.assertIsNone(gate.acquire())
+        self.assertEqual(gate.stats()['queue_seconds'], 0.0)
+
+    def test_sheds_when_already_waited_upstream(self):
+        """Time spent queued at the proxy counts toward max_wait."""
+
+        gate = Gate('write', limit=1, max_queue=1, max_wait=0.5,
+                    retry_after=1)
+
+        self.assertIsNone(gate.acquire(already_waited=2.0))
+        self.assertIsNotNone(gate.acquire(already_waited=0.1))
+
+    def test_file_slots_shared_between_gates(self):
+        """Gates on the same slot dir share one limit, as workers would."""
+
+        with tempfile.TemporaryDirectory() as slot_dir:
+            first = Gate('write', 1, 0, 0, 1, slot_dir=slot_dir)
+            second = Gate('write', 1, 0, 0, 1, slot_dir=slot_dir)
+
+            token = first.acquire()
+            self.assertIsNotNone(token)
+            self.assertIsNone(second.acquire())
+
+            first.release(token)
+            self.assertIsNotNone(second.acquire())
+
+    def test_file_slots_host_wide_gauges(self):
+        """With a slot dir, in-flight and queue depth cover every gate."""
+
+        with tempfile.TemporaryDirectory() as slot_dir:
+            first = Gate('write', 1, 1, 5, 1, slot_dir=slot_dir)
+            second = Gate('write', 1, 1, 5, 1, slot_dir=slot_dir)
+
+            token = first.acquire()
+            self.assertEqual(second.stats()['in_flight'], 1)
+
+            waiter = threading.Thread(target=second.acquire)
+            waiter.start()
+            deadline = time.monotonic() + 1
+            while (first.stats()['queued'] == 0 and
+                   time.monotonic() < deadline):
+                time.sleep(0.005)
+
+            self.assertEqual(first.stats()['queued'], 1)
+            # The one queue place is taken, so a third request is shed.
+            self.assertIsNone(first.acquire())
+
+            first.release(token)
+            waiter.join()
+            self.assertEqual(first.stats()['queued'], 0)
+            self.assertEqual(first.stats()['in_flight'], 1)
+
+    def test_file_slots_wait_for_release(self):
+        """FileSlots gives up after its timeout."""
+
+        with tempfile.TemporaryDirectory() as slot_dir:
+            slots = FileSlots(slot_dir, 'write', 1)
+            fd = slots.acquire(0)
+
+            start = time.monotonic()
+            self.assertIsNone(slots.acquire(0.02))
+            self.assertGreaterEqual(time.monotonic() - start, 0.02)
+
+            slots.release(fd)
+            self.assertIsNotNone(slots.acquire(0))
+
+
+class UpstreamWaitTestCase(TestCase):
+    """Test parsing proxy request-start headers."""
+
+    def test_units(self):
+        """Seconds, milliseconds and microseconds are all understood."""
+
+        now = 1700000010.0
+        self.assertAlmostEqual(upstream_wait('t=1700000000', now), 10.0)
+        self.assertAlmostEqual(upstream_wait('1700000000000', now), 10.0)
+        self.assertAlmostEqual(
+            upstream_wait('t=1700000000000000', now), 10.0)
+
+    def test_bad_header(self):
+        """A missing, garbled or future header counts as no wait."""
+
+        self.assertEqual(upstream_wait(None), 0.0)
+        self.assertEqual(upstream_wait('t=soon'), 0.0)
+        self.assertEqual(upstream_wait(f't={time.time() + 60}'), 0.0)
+
+
+class AdmissionControlTestCase(TestCase):
+    """Test routing endpoints to priority classes."""
+
+    def test_gate_for(self):
+        """Endpoints map to their class, static is exempt."""
+
+        admission = AdmissionControl()
+        admission.gates = {name: Gate(name, 1, 1, 0, 1)
+                           for name in ('write', 'expensive', 'default')}
+        admission.routes = {'warbler.add_follow': 'write',
+                            'warbler.homepage': 'expensive'}
+        admission.exempt = {'static'}
+
+        self.assertEqual(admission.gate_for('warbler.add_follow').name,
+                         'write')
+        self.assertEqual(admission.gate_for('warbler.homepage').name,
+                         'expensive')
+        self.assertEqual(admission.gate_for('warbler.login').name, 'default')
+        self.assertIsNone(admission.gate_for('static'))
+        self.assertIsNone(admission.gate_for(None))
+
+
+class AdmissionViewsTestCase(TestCase):
+    """Test shedding through the app."""
+
+    def setUp(self):
+        self.app = create_app(AdmissionConfig)
+        self.client = self.app.test_client()
+        self.gate = self.app.extensions['admission'].gates['default']
+
+    def test_full_class_is_shed(self):
+        """With every slot taken, requests get a 503 and Retry-After."""
+
+        token = self.gate.acquire()
+        try:
+            resp = self.client.get('/login')
+        finally:
+            self.gate.release(token)
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '7')
+
+        resp = self.client.get('/login')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.gate.stats()['in_flight'], 0)
+
+    def test_exempt_endpoints(self):
+        """Static files and /metrics are served even when full."""
+
+        token = self.gate.acquire()
+        try:
+            static = self.client.get('/static/favicon.ico')
+            metrics = self.client.get('/metrics')
+        finally:
+            self.gate.release(token)
+
+        self.assertEqual(static.status_code, 200)
+        self.assertEqual(metrics.status_code, 200)
+        self.assertIn(b'admission_shed_total', metrics.data)
+
+    def test_queued_too_long_upstream(self):
+        """A request that waited at the proxy past max_wait is shed."""
+
+        resp = self.client.get(
+            '/login', headers={'X-Request-Start': f't={time.time() - 5}'})
+
+        self.assertEqual(resp.status_code, 503)
+
+
+class SharedAdmissionViewsTestCase(TestCase):
+    """Test host-wide gauges through /metrics."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        slot_dir = self.tmp.name
+
+        class SharedAdmissionConfig(AdmissionConfig):
+            ADMISSION_SLOT_DIR = slot_dir
+
+        self.app = create_app(SharedAdmissionConfig)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_other_workers_in_flight(self):
+        """A slot held by another worker shows up in this one's scrape."""
+
+        other_worker = Gate('default', 1, 0, 0, 7, slot_dir=self.tmp.name)
+
+        token = other_worker.acquire()
+        try:
+            resp = self.app.test_client().get('/metrics')
+        finally:
+            other_worker.release(token)
+
+        self.assertIn('admission_in_flight{class="default"} 1',
+                      resp.get_data(as_text=True))
@@ -0,0 +1,225 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
+
+from models import db, User, Message
+from app import create_app, CURR_USER_KEY
+import archive
+from archive import (
+    MessageArchive, add_months, archive_cutoff, drop_month, maintain)
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class MonthTestCase(TestCase):
+    """Test month arithmetic used for partitions."""
+
+    def test_add_months(self):
+        """Months roll over year boundaries both ways."""
+
+        self.assertEqual(add_months(datetime(2026, 11, 1), 3),
+                         datetime(2027, 2, 1))
+        self.assertEqual(add_months(datetime(2026, 1, 1), -1),
+                         datetime(2025, 12, 1))
+
+    def test_archive_cutoff(self):
+        """Cutoff is the start of the month retention reaches back to."""
+
+        self.assertEqual(archive_cutoff(datetime(2026, 10, 19), 30),
+                         datetime(2026, 9, 1))
+
+
+class MessageArchiveTestCase(TestCase):
+    """Test writing and reading archive files."""
+
+    def setUp(self):
+        """Archive into a fresh temp directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = MessageArchive(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_and_find(self):
+        """Archived rows can be found by id."""
+
+        month = datetime(2025, 1, 1)
+        rows = [(1, "first", datetime(2025, 1, 2, 3, 4, 5), 10),
+                (7, "second", datetime(2025, 1, 30), 11)]
+
+        self.assertEqual(self.archive.write_month(month, iter(rows)), 2)
+
+        found = self.archive.find(7)
+        self.assertEqual(found['text'], "second")
+        self.assertEqual(found['user_id'], 11)
+        self.assertEqual(found['timestamp'], datetime(2025, 1, 30))
+
+        self.assertIsNone(self.archive.find(5))
+        self.assertIsNone(self.archive.find(100))
+
+    def test_same_month_twice(self):
+        """Archiving a month again adds a file instead of overwriting."""
+
+        month = datetime(2025, 1, 1)
+        self.archive.write_month(month, [(1, "a", datetime(2025, 1, 2), 1)])
+        self.archive.write_month(month, [(2, "b", datetime(2025, 1, 3), 1)])
+
+        self.assertEqual(len(self.archive.manifest()), 2)
+        self.assertEqual(self.archive.find(1)['text'], "a")
+        self.assertEqual(self.archive.find(2)['text'], "b")
+
+    def test_empty_month(self):
+        """An empty month leaves no file behind."""
+
+        self.assertEqual(self.archive.write_month(datetime(2025, 1, 1), []), 0)
+        self.assertEqual(self.archive.manifest(), [])
+
+    def test_sparse_index(self):
+        """Lookups seek to the right gzip member via the index."""
+
+        month = datetime(2025, 1, 1)
+        rows = [(i, f"row {i}", datetime(2025, 1, 2), 1)
+                for i in range(1, 200, 2)]
+
+        with mock.patch('archive.INDEX_EVERY', 10):
+            self.archive.write_month(month, rows)
+
+        fresh = MessageArchive(self.tmp.name)
+        path = os.path.join(self.tmp.name, 'messages-2025-01.ndjson.gz')
+        self.assertGreater(fresh._offset(path, 151), 0)
+        self.assertEqual(fresh._offset(path, 1), 0)
+
+        self.assertEqual(fresh.find(151)['text'], "row 151")
+        self.assertEqual(fresh.find(199)['text'], "row 199")
+        self.assertIsNone(fresh.find(150))
+
+
+class MaintainTestCase(TestCase):
+    """Test archiving a plain (SQLite-style) messages table."""
+
+    def setUp(self):
+        """Create a user with one expired and one recent message."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.tmp.name
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        old = Message(text="old news", timestamp=datetime(2024, 1, 15),
+                      user_id=self.user_id)
+        new = Message(text="fresh", timestamp=datetime.utcnow(),
+                      user_id=self.user_id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        self.old_id, self.new_id = old.id, new.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def test_drop_month(self):
+        """Only the given month's rows are deleted."""
+
+        with db.engine.begin() as conn:
+            drop_month(conn, datetime(2024, 1, 1))
+
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertIsNotNone(Message.query.get(self.new_id))
+
+    def test_drop_month_max_id(self):
+        """Rows added after the archived ones are kept."""
+
+        late = Message(text="late", timestamp=datetime(2024, 1, 20),
+                       user_id=self.user_id)
+        db.session.add(late)
+        db.session.commit()
+        late_id = late.id
+
+        with db.engine.begin() as conn:
+            drop_month(conn, datetime(2024, 1, 1), max_id=self.old_id)
+
+        db.session.expire_all()
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertIsNotNone(Message.query.get(late_id))
+
+    def test_row_added_while_archiving(self):
+        """A row that shows up mid-archive is left for the next run."""
+
+        stream_month = archive.stream_month
+
+        def stream_then_insert(conn, month):
+            yield from stream_month(conn, month)
+            if month != datetime(2024, 1, 1):
+                return
+            conn.execute(Message.__table__.insert().values(
+                text="imported", timestamp=datetime(2024, 1, 25),
+                user_id=self.user_id))
+
+        with mock.patch('archive.stream_month', stream_then_insert):
+            self.assertEqual(maintain(app, now=datetime.utcnow()),
+                             [(datetime(2024, 1, 1), 1)])
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.filter_by(text="imported").count(), 1)
+        self.assertEqual(maintain(app, now=datetime.utcnow()),
+                         [(datetime(2024, 1, 1), 1)])
+        self.assertEqual(Message.query.filter_by(text="imported").count(), 0)
+
+    def test_maintain(self):
+        """Expired months move to the archive; recent ones stay."""
+
+        archived = maintain(app, now=datetime.utcnow())
+
+        self.assertEqual(archived, [(datetime(2024, 1, 1), 1)])
+        db.session.expire_all()
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertIsNotNone(Message.query.get(self.new_id))
+
+        found = MessageArchive(self.tmp.name).find(self.old_id)
+        self.assertEqual(found['text'], "old news")
+
+        self.assertEqual(maintain(app, now=datetime.utcnow()), [])
+
+    def test_show_archived_message(self):
+        """An archived message is still shown, without the actions."""
+
+        maintain(app, now=datetime.utcnow())
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/messages/{self.old_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old news", str(resp.data))
+            self.assertNotIn("Delete", str(resp.data))
+
+            resp = c.get(f"/messages/{self.new_id}")
+            self.assertIn("Delete", str(resp.data))
+
+            resp = c.post(f"/messages/{self.old_id}/delete")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get("/messages/999999")
+            self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,169 @@
+"""Message batching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_batching.py
+
+
+from threading import Thread
+from unittest import TestCase, mock
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message
+from app import create_app, CURR_USER_KEY
+from config import TestingConfig
+
+
+class BatchingConfig(TestingConfig):
+    """Testing profile with group commit on."""
+
+    MESSAGE_BATCHING_ENABLED = True
+    MESSAGE_BATCH_SIZE = 10
+    MESSAGE_BATCH_DELAY = 0.05
+
+
+app = create_app(BatchingConfig)
+
+db.create_all()
+
+
+class MessageBatcherTestCase(TestCase):
+    """Test group-committing messages from concurrent posts."""
+
+    def setUp(self):
+        """Create a user to post as."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.batcher = app.extensions['message_batcher']
+
+    def test_concurrent_posts(self):
+        """Every concurrent post gets its own id and is committed."""
+
+        ids = {}
+
+        def post(n):
+            ids[n] = self.batcher.post(self.user_id, f"message {n}")
+
+        threads = [Thread(target=post, args=(n,)) for n in range(25)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(ids.values())), 25)
+        for n, message_id in ids.items():
+            self.assertEqual(Message.query.get(message_id).text,
+                             f"message {n}")
+
+    def test_error_is_per_post(self):
+        """A failing post doesn't fail the rest of its batch."""
+
+        results = {}
+
+        def post(n, user_id):
+            try:
+                results[n] = self.batcher.post(user_id, f"message {n}")
+            except Exception as e:
+                results[n] = e
+
+        threads = [Thread(target=post, args=(0, self.user_id)),
+                   Thread(target=post, args=(1, None)),
+                   Thread(target=post, args=(2, self.user_id))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertIsInstance(results[0], int)
+        self.assertIsInstance(results[1], Exception)
+        self.assertIsInstance(results[2], int)
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_flusher_survives_errors(self):
+        """A batch that blows up fails its posts, not the thread."""
+
+        with mock.patch.object(self.batcher, '_flush',
+                               side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.batcher.post(self.user_id, "lost")
+
+        message_id = self.batcher.post(self.user_id, "kept")
+        self.assertEqual(Message.query.get(message_id).text, "kept")
+
+
+class BatchedViewTestCase(TestCase):
+    """Test posting through messages_add with batching on."""
+
+    def setUp(self):
+        """Create a user and log them in."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.batcher = app.extensions['message_batcher']
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def post(self, threaded=True):
+        return self.client.post(
+            '/messages/new', data={'text': 'Hello'},
+            environ_overrides={'wsgi.multithread': threaded})
+
+    def test_threaded_server_uses_batcher(self):
+        """Threaded servers hand posts to the batcher."""
+
+        with mock.patch.object(self.batcher, 'post') as post:
+            resp = self.post()
+
+        self.assertEqual(resp.status_code, 302)
+        post.assert_called_once_with(self.user_id, 'Hello')
+
+    def test_sync_server_posts_directly(self):
+        """Single-threaded workers skip the batcher and its delay."""
+
+        with mock.patch.object(self.batcher, 'post') as post:
+            resp = self.post(threaded=False)
+
+        self.assertEqual(resp.status_code, 302)
+        post.assert_not_called()
+        self.assertEqual(Message.query.one().text, 'Hello')
+
+    def test_timeout(self):
+        """A timed-out post redirects with a warning instead of a 500."""
+
+        with mock.patch.object(self.batcher, 'post',
+                               side_effect=TimeoutError):
+            resp = self.post()
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, f"/users/{self.user_id}")
+        with self.client.session_transaction() as sess:
+            self.assertIn('taking a while', str(sess['_flashes']))
+
+    def test_db_error(self):
+        """A failed insert shows the form again with an error."""
+
+        error = OperationalError("INSERT", {}, Exception("db down"))
+        with mock.patch.object(self.batcher, 'post', side_effect=error):
+            resp = self.post()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Couldn&#39;t post your message", str(resp.data))
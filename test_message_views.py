@@ -2,25 +2,18 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_message_views.py
+#    python -m unittest test_message_views.py
 
 
-import os
 from unittest import TestCase
 
 from models import db, connect_db, Message, User
+from app import create_app, CURR_USER_KEY
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# The testing profile points at the warbler-test database and
+# turns off CSRF, since it's a pain to test
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -28,10 +21,6 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -0,0 +1,212 @@
+"""Metrics registry tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import TestCase
+
+from sqlalchemy.exc import OperationalError
+
+from app import create_app
+from config import ProductionConfig, TestingConfig
+from metrics import REGISTRY, Registry, Counter, Histogram
+from models import db
+
+
+class MetricsConfig(TestingConfig):
+    """Testing profile with /metrics on and a scrape token."""
+
+    METRICS_ENABLED = True
+    METRICS_TOKEN = 'scrape-secret'
+
+
+class RegistryTestCase(TestCase):
+    """Test counting and text exposition."""
+
+    def setUp(self):
+        """Create a private registry with one counter and one histogram."""
+
+        self.registry = Registry()
+        self.requests = Counter('requests_total', 'Requests.', ['endpoint'],
+                                registry=self.registry)
+        self.latency = Histogram('latency_seconds', 'Latency.',
+                                 registry=self.registry, buckets=(.1, 1))
+
+    def test_counts_across_threads(self):
+        """Increments from many threads all show up."""
+
+        def work():
+            for _ in range(1000):
+                self.requests.inc(endpoint='home')
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertIn('requests_total{endpoint="home"} 8000',
+                      self.registry.expose())
+
+    def test_histogram_exposition(self):
+        """Buckets are cumulative and end with +Inf, _sum and _count."""
+
+        for value in (.05, .5, 5):
+            self.latency.observe(value)
+
+        text = self.registry.expose()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_sum 5.55', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def test_multiproc_totals(self):
+        """Other workers' dumped totals are added to live values."""
+
+        self.requests.inc(endpoint='home')
+        self.latency.observe(.5)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.registry.dump(os.path.join(tmp, 'other-worker.json'))
+            text = self.registry.expose(tmp)
+
+        self.assertIn('requests_total{endpoint="home"} 2', text)
+        self.assertIn('latency_seconds_count 2', text)
+
+    def test_register_cache(self):
+        """Cache hooks report hits, misses and ratio."""
+
+        self.registry.register_cache('timeline', lambda: (3, 1))
+        text = self.registry.expose()
+
+        self.assertIn('cache_hits_total{cache="timeline"} 3', text)
+        self.assertIn('cache_hit_ratio{cache="timeline"} 0.75', text)
+
+    def test_dead_thread_shards_are_folded(self):
+        """Exited threads' shards are merged away but still counted."""
+
+        threads = [threading.Thread(target=self.requests.inc,
+                                    kwargs={'endpoint': 'home'})
+                   for _ in range(100)]
+        for t in threads:
+            t.start()
+            t.join()
+
+        self.assertIn('requests_total{endpoint="home"} 100',
+                      self.registry.expose())
+        self.assertEqual(len(self.registry._shards), 0)
+
+    def test_dead_workers_are_compacted(self):
+        """An exited worker's dump moves into the aggregate, once."""
+
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+
+        self.requests.inc(endpoint='home')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dead = os.path.join(tmp, f"{proc.pid}-1.json")
+            with open(dead, 'w') as f:
+                json.dump([['requests_total', ['home'], 5]], f)
+
+            first = self.registry.expose(tmp)
+            second = self.registry.expose(tmp)
+            files = sorted(os.listdir(tmp))
+
+        self.assertIn('requests_total{endpoint="home"} 6', first)
+        self.assertIn('requests_total{endpoint="home"} 6', second)
+        self.assertNotIn(f"{proc.pid}-1.json", files)
+        self.assertIn('aggregate.json', files)
+
+    def test_process_id_is_unique(self):
+        """Dumps are keyed by pid and start time, not just pid."""
+
+        pid, started = self.registry.process_id.split('-')
+        self.assertEqual(int(pid), os.getpid())
+        self.assertTrue(started.isdigit())
+
+
+class ProxiedMetricsConfig(MetricsConfig):
+    """Like production: behind a proxy, no IP is trusted."""
+
+    METRICS_ALLOWED_IPS = ProductionConfig.METRICS_ALLOWED_IPS
+
+
+class MetricsViewTestCase(TestCase):
+    """Test access control on /metrics."""
+
+    def setUp(self):
+        self.client = create_app(MetricsConfig).test_client()
+
+    def test_allowed_ip(self):
+        """Local scrapers don't need the token."""
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'http_requests_total', resp.data)
+
+    def test_other_ip_needs_token(self):
+        """Anyone else gets a 403 unless they send the bearer token."""
+
+        remote = {'REMOTE_ADDR': '203.0.113.5'}
+
+        resp = self.client.get('/metrics', environ_base=remote)
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.get('/metrics', environ_base=remote,
+                               headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.get(
+            '/metrics', environ_base=remote,
+            headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_behind_proxy_needs_token(self):
+        """Proxied requests come from loopback but still need the token."""
+
+        client = create_app(ProxiedMetricsConfig).test_client()
+        proxied = {'REMOTE_ADDR': '127.0.0.1'}
+        headers = {'X-Forwarded-For': '203.0.113.5'}
+
+        resp = client.get('/metrics', environ_base=proxied, headers=headers)
+        self.assertEqual(resp.status_code, 403)
+
+        resp = client.get(
+            '/metrics', environ_base=proxied,
+            headers={**headers, 'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(resp.status_code, 200)
+
+
+class QueryTimingTestCase(TestCase):
+    """Test the SQLAlchemy query hooks."""
+
+    def setUp(self):
+        self.app = create_app(MetricsConfig)
+
+    def query_count(self):
+        counts = REGISTRY.values().get(('db_query_duration_seconds', ()))
+        return sum(counts[:-1]) if counts else 0
+
+    def test_failed_queries(self):
+        """Failing statements are timed and leave nothing behind."""
+
+        before = self.query_count()
+
+        with self.app.app_context(), db.engine.connect() as conn:
+            for _ in range(5):
+                with self.assertRaises(OperationalError):
+                    conn.execute("SELECT * FROM no_such_table")
+            self.assertEqual(conn.info['metrics_query_start'], {})
+
+        self.assertEqual(self.query_count(), before + 5)
@@ -0,0 +1,189 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import glob
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db
+from app import create_app
+from config import TestingConfig
+from profiler import HEADER
+
+
+class ProfilerConfig(TestingConfig):
+    """Testing profile with the profiler on."""
+
+    PROFILER_ENABLED = True
+    PROFILER_TOKEN = 'let-me-profile'
+    PROFILER_INTERVAL = 0.001
+    PROFILER_MIN_INTERVAL = 0
+
+
+def slow_query():
+    """Test view that spends a while inside one SQL statement."""
+
+    db.session.execute(text(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL "
+        "SELECT i + 1 FROM n WHERE i < 300000) SELECT COUNT(*) FROM n"))
+    return "done"
+
+
+def failed_query():
+    """Test view whose query fails, followed by plain Python work."""
+
+    try:
+        db.session.execute(text("SELECT * FROM no_such_table"))
+    except OperationalError:
+        db.session.rollback()
+
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    return "done"
+
+
+class ProfilerTestCase(TestCase):
+    """Test which requests get profiled and what gets written."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        app = create_app(ProfilerConfig)
+        app.add_url_rule('/slow-query', 'slow_query', slow_query)
+        app.add_url_rule('/failed-query', 'failed_query', failed_query)
+        self.profiler = app.extensions['profiler']
+        self.profiler.directory = self.tmp.name
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def profiles(self, ext='json'):
+        return glob.glob(os.path.join(self.tmp.name, f"*.{ext}"))
+
+    def test_token_triggers_profile(self):
+        """The right token profiles the request and names the files."""
+
+        resp = self.client.get('/login', headers={HEADER: 'let-me-profile'})
+
+        self.assertEqual(resp.status_code, 200)
+        name = resp.headers[HEADER]
+        path = os.path.join(self.tmp.name, name)
+        self.assertTrue(os.path.exists(f"{path}.folded"))
+
+        with open(f"{path}.json") as f:
+            info = json.load(f)
+        self.assertEqual(info['endpoint'], 'warbler.login')
+        self.assertEqual(info['trigger'], 'token')
+
+    def test_unwritable_dir(self):
+        """A profile that can't be saved doesn't fail the request."""
+
+        self.profiler.directory = '/proc/nope'
+
+        with self.assertLogs('warbler.profiler', 'ERROR'):
+            resp = self.client.get('/login',
+                                   headers={HEADER: 'let-me-profile'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn(HEADER, resp.headers)
+
+        self.profiler.directory = self.tmp.name
+        resp = self.client.get('/login', headers={HEADER: 'let-me-profile'})
+        self.assertIn(HEADER, resp.headers)
+
+    def test_wrong_or_missing_token(self):
+        """Without the right token nothing is profiled."""
+
+        for headers in ({HEADER: 'guess'}, {HEADER: 'caf\xe9'}, {}):
+            resp = self.client.get('/login', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(HEADER, resp.headers)
+
+        self.assertEqual(self.profiles(), [])
+
+    def test_sampled_requests_are_not_echoed(self):
+        """Randomly sampled requests are saved but not told about it."""
+
+        self.profiler.sample_rate = 1.0
+        resp = self.client.get('/login')
+
+        self.assertNotIn(HEADER, resp.headers)
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_min_interval(self):
+        """A second profile too soon after the first is skipped."""
+
+        self.profiler.min_interval = 60
+        headers = {HEADER: 'let-me-profile'}
+
+        first = self.client.get('/login', headers=headers)
+        second = self.client.get('/login', headers=headers)
+
+        self.assertIn(HEADER, first.headers)
+        self.assertNotIn(HEADER, second.headers)
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_prune_keeps_max_files(self):
+        """Only the newest PROFILER_MAX_FILES profiles are kept."""
+
+        self.profiler.max_files = 2
+        for n in range(4):
+            base = os.path.join(self.tmp.name, f"old-{n}")
+            for ext in ('json', 'folded'):
+                with open(f"{base}.{ext}", 'w') as f:
+                    f.write("{}")
+                os.utime(f"{base}.{ext}", (n, n))
+
+        self.profiler._prune()
+
+        self.assertEqual(sorted(os.path.basename(p) for p in self.profiles()),
+                         ['old-2.json', 'old-3.json'])
+        self.assertEqual(len(self.profiles('folded')), 2)
+
+    def test_sql_frames(self):
+        """Samples taken inside a DB call end in a [sql] frame."""
+
+        resp = self.client.get('/slow-query',
+                               headers={HEADER: 'let-me-profile'})
+        path = os.path.join(self.tmp.name, resp.headers[HEADER])
+
+        with open(f"{path}.folded") as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(any(line.rsplit(' ', 1)[0].endswith(';[sql]')
+                            for line in stacks))
+
+        with open(f"{path}.json") as f:
+            info = json.load(f)
+        self.assertGreaterEqual(info['sql_queries'], 1)
+        self.assertGreater(info['sql_seconds'], 0)
+
+    def test_failed_query_leaves_sql(self):
+        """After a failed statement, samples are no longer tagged [sql]."""
+
+        resp = self.client.get('/failed-query',
+                               headers={HEADER: 'let-me-profile'})
+        path = os.path.join(self.tmp.name, resp.headers[HEADER])
+
+        with open(f"{path}.folded") as f:
+            stacks = [line.rsplit(' ', 1)[0] for line in f]
+        # Samples from the busy loop itself, after the query failed.
+        leaf = 'test_profiler.py:failed_query'
+        self.assertTrue(any(stack.endswith(leaf) for stack in stacks))
+        self.assertFalse(any(stack.endswith(f"{leaf};[sql]")
+                             for stack in stacks))
+
+        with open(f"{path}.json") as f:
+            self.assertEqual(json.load(f)['sql_queries'], 1)
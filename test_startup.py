@@ -0,0 +1,56 @@
+"""Startup timing log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_startup.py
+
+
+import logging
+from unittest import TestCase
+
+from app import _log_startup_timing, _startup_fallback, startup_logger
+
+
+class RecordingHandler(logging.Handler):
+    """Keep every record it is given."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StartupLoggingTestCase(TestCase):
+    """Test where startup timing is logged."""
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.saved = self.root.handlers[:], self.root.level
+        self.root.handlers = []
+        self.root.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        self.root.handlers, level = self.saved
+        self.root.setLevel(level)
+        startup_logger.removeHandler(_startup_fallback)
+
+    def test_uses_root_handlers(self):
+        """With logging configured, records propagate to it at INFO."""
+
+        handler = RecordingHandler()
+        self.root.addHandler(handler)
+
+        _log_startup_timing({'config': 0.001, 'total': 0.002})
+
+        self.assertEqual(len(handler.records), 1)
+        self.assertIn("config=1.0ms", handler.records[0].getMessage())
+        self.assertNotIn(_startup_fallback, startup_logger.handlers)
+
+    def test_fallback_without_logging_config(self):
+        """With nothing configured, a stderr handler is added."""
+
+        _log_startup_timing({'total': 0.002})
+
+        self.assertIn(_startup_fallback, startup_logger.handlers)
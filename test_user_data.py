@@ -0,0 +1,195 @@
+"""User data export format tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_data.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+from app import create_app, CURR_USER_KEY
+from archive import maintain
+from user_data import (
+    export_records, import_records, to_csv, to_ndjson, read_csv,
+    read_ndjson)
+
+app = create_app('testing')
+
+db.create_all()
+
+RECORDS = [
+    {'type': 'user', 'id': 1, 'username': 'testuser',
+     'email': 'test@test.com', 'password': 'HASHED'},
+    {'type': 'message', 'id': 5, 'text': 'Hello, "world"',
+     'timestamp': datetime(2025, 1, 2, 3, 4, 5)},
+    {'type': 'following', 'id': 2, 'username': 'other'},
+    {'type': 'like', 'id': 9, 'timestamp': datetime(2025, 2, 1),
+     'author': 'other'},
+]
+
+
+class ExportFormatTestCase(TestCase):
+    """Test that exports read back as the same records."""
+
+    def test_ndjson_round_trip(self):
+        """NDJSON export reads back unchanged."""
+
+        lines = "".join(to_ndjson(RECORDS)).splitlines(keepends=True)
+        self.assertEqual(len(lines), len(RECORDS))
+        self.assertEqual(list(read_ndjson(lines)), RECORDS)
+
+    def test_csv_round_trip(self):
+        """CSV export reads back unchanged, minus empty columns."""
+
+        lines = "".join(to_csv(RECORDS)).splitlines(keepends=True)
+        self.assertEqual(len(lines), len(RECORDS) + 1)
+        self.assertEqual(list(read_csv(lines)), RECORDS)
+
+
+class ImportExportTestCase(TestCase):
+    """Test exporting a user from the database and importing it back."""
+
+    def setUp(self):
+        """Create alice, who posts, follows, is followed and likes."""
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_ARCHIVE_DIR'] = os.path.join(self.tmp.name,
+                                                         'archive')
+
+        alice, bob, carol = [User.signup(username=name,
+                                         email=f"{name}@test.com",
+                                         password="password",
+                                         image_url=None)
+                             for name in ('alice', 'bob', 'carol')]
+        db.session.commit()
+
+        bob_msg = Message(text="bob says", user_id=bob.id,
+                          timestamp=datetime(2025, 3, 1))
+        db.session.add_all([
+            Message(text="first", user_id=alice.id,
+                    timestamp=datetime(2025, 1, 1)),
+            Message(text="second", user_id=alice.id,
+                    timestamp=datetime(2025, 2, 1)),
+            bob_msg,
+            Follows(user_following_id=alice.id,
+                    user_being_followed_id=bob.id),
+            Follows(user_following_id=carol.id,
+                    user_being_followed_id=alice.id),
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=alice.id, message_id=bob_msg.id))
+        db.session.commit()
+
+        self.alice_id = alice.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def test_web_export_omits_password(self):
+        """The download never contains the password hash."""
+
+        alice = User.query.get(self.alice_id)
+        with app.app_context():
+            self.assertNotIn('password', next(export_records(alice)))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice_id
+            resp = c.get('/users/export')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Disposition'],
+                         f'attachment; filename="warbler-{self.alice_id}'
+                         f'.ndjson"')
+        self.assertNotIn(alice.password, resp.get_data(as_text=True))
+        self.assertIn('"author": "bob"', resp.get_data(as_text=True))
+
+    def test_import_restores_related_rows(self):
+        """Messages, follows and likes come back; unknowns are counted."""
+
+        alice = User.query.get(self.alice_id)
+        with app.app_context():
+            records = list(export_records(alice, include_password=True))
+        records.append({'type': 'following', 'username': 'ghost'})
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.filter_by(user_id=self.alice_id).delete()
+        User.query.filter_by(id=self.alice_id).delete()
+        db.session.commit()
+
+        counts = import_records(records)
+        db.session.commit()
+
+        self.assertEqual(counts, {'user': 1, 'message': 2, 'following': 1,
+                                  'following_skipped': 1, 'follower': 1,
+                                  'like': 1})
+
+        alice = User.query.filter_by(username='alice').one()
+        self.assertTrue(User.authenticate('alice', 'password'))
+        self.assertEqual(sorted(m.text for m in alice.messages),
+                         ["first", "second"])
+        self.assertEqual([u.username for u in alice.following], ['bob'])
+        self.assertEqual([u.username for u in alice.followers], ['carol'])
+        self.assertEqual([m.text for m in alice.likes], ["bob says"])
+
+    def test_import_existing_username(self):
+        """Importing over an existing user is refused."""
+
+        alice = User.query.get(self.alice_id)
+        with app.app_context():
+            records = list(export_records(alice, include_password=True))
+
+        with self.assertRaises(ValueError):
+            import_records(records)
+
+    def test_export_includes_archive(self):
+        """Archived messages, and likes of them, are still exported."""
+
+        maintain(app)
+        self.assertEqual(Message.query.count(), 0)
+
+        with app.app_context():
+            records = list(export_records(User.query.get(self.alice_id)))
+
+        self.assertEqual([r['text'] for r in records
+                          if r['type'] == 'message'], ["first", "second"])
+        self.assertEqual([(r['author'], r['timestamp']) for r in records
+                          if r['type'] == 'like'],
+                         [('bob', datetime(2025, 3, 1))])
+
+    def test_cli_csv_keeps_crlf(self):
+        """Line breaks inside fields survive a CSV export and import."""
+
+        alice = User.query.get(self.alice_id)
+        alice.bio = "line one\r\nline two"
+        db.session.commit()
+
+        path = os.path.join(self.tmp.name, 'alice.csv')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['users', 'export', str(self.alice_id),
+                                     '--format', 'csv', '-o', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.filter_by(user_id=self.alice_id).delete()
+        User.query.filter_by(id=self.alice_id).delete()
+        db.session.commit()
+
+        result = runner.invoke(args=['users', 'import', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        alice = User.query.filter_by(username='alice').one()
+        self.assertEqual(alice.bio, "line one\r\nline two")
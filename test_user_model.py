@@ -5,22 +5,14 @@
 #    python -m unittest test_user_model.py
 
 
-import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows
+from app import create_app
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# The testing profile points at the warbler-test database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -0,0 +1,124 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_views.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+from app import create_app, CURR_USER_KEY
+
+# The testing profile points at the warbler-test database and
+# turns off CSRF, since it's a pain to test
+
+app = create_app('testing')
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class FollowViewTestCase(TestCase):
+    """Test views for following and unfollowing."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"user{i}",
+                             email=f"user{i}@test.com",
+                             password="password",
+                             image_url=None)
+                 for i in range(3)]
+        db.session.commit()
+
+        self.user_id, self.other_id, self.third_id = [u.id for u in users]
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_follow_and_stop_following(self):
+        """Can a user follow and then unfollow someone?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post(f"/users/follow/{self.other_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+
+            resp = c.post(f"/users/stop-following/{self.other_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_follow_missing_user(self):
+        """Following a missing user 404s; unfollowing one doesn't crash."""
+
+        with self.client as c:
+            self.login(c)
+
+            self.assertEqual(c.post("/users/follow/999999").status_code, 404)
+            self.assertEqual(
+                c.post("/users/stop-following/999999").status_code, 302)
+
+    def test_bulk_follow(self):
+        """Bulk follow reports a status for every id."""
+
+        with self.client as c:
+            self.login(c)
+            c.post(f"/users/follow/{self.other_id}")
+
+            resp = c.post("/users/following/bulk", json={
+                'action': 'follow',
+                'ids': [self.user_id, self.other_id, self.third_id, 999999],
+            })
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['results'], {
+                str(self.user_id): 'self',
+                str(self.other_id): 'already_following',
+                str(self.third_id): 'followed',
+                '999999': 'not_found',
+            })
+            self.assertEqual(Follows.query.count(), 2)
+
+    def test_bulk_unfollow(self):
+        """Bulk unfollow reports which follows were removed."""
+
+        with self.client as c:
+            self.login(c)
+            c.post(f"/users/follow/{self.other_id}")
+
+            resp = c.post("/users/following/bulk", json={
+                'action': 'unfollow',
+                'ids': [self.other_id, self.third_id],
+            })
+
+            self.assertEqual(resp.json['results'], {
+                str(self.other_id): 'unfollowed',
+                str(self.third_id): 'not_following',
+            })
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_bulk_follow_bad_request(self):
+        """Bulk follow rejects bad input and anonymous users."""
+
+        resp = self.client.post("/users/following/bulk",
+                                json={'action': 'follow', 'ids': [1]})
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/users/following/bulk",
+                          json={'action': 'follow', 'ids': ["1"]})
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,335 @@
+"""Streaming export and import of one user's data.
+
+An export is a stream of records. The first is the user; then come their
+messages, the users they follow, their followers and their likes. Each
+record is a dict with a 'type' key, written as NDJSON (one object per
+line) or as CSV (one row per record, using the FIELDS columns).
+
+All reads use Query.yield_per, which on Postgres means a server-side
+cursor. So memory stays bounded however many rows the user has. Imports
+write in batches with bulk_insert_mappings, the same bulk path seed.py
+uses.
+
+Messages moved to the cold archive (see archive.py) are exported too,
+read from the archive files, as are likes of archived messages. That
+means reading every archive file, which is why exports are their own
+admission class.
+
+Ids differ between environments, so follows are exported by username.
+Likes are exported by the liked message's author and timestamp, and
+mapped back to ids on import. Related rows that don't exist in the
+target database are skipped and counted.
+
+    flask users export 42 --format csv -o user42.csv
+    flask users import user42.csv
+"""
+
+import csv
+import io
+import json
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import tuple_
+
+from archive import get_archive
+from models import db, User, Message, Follows, Likes
+
+users_cli = AppGroup('users', help="User data export and import.")
+
+BATCH_SIZE = 1000
+
+USER_FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url',
+               'bio', 'location', 'password')
+
+FIELDS = ('type', 'id', 'username', 'email', 'image_url', 'header_image_url',
+          'bio', 'location', 'password', 'text', 'timestamp', 'author')
+
+INT_FIELDS = ('id',)
+
+RELATED_TYPES = ('message', 'following', 'follower', 'like')
+
+
+##############################################################################
+# Export
+
+
+def export_records(user, include_password=False):
+    """Yield every record for `user`, reading in batches."""
+
+    record = {f: getattr(user, f) for f in USER_FIELDS}
+    if not include_password:
+        del record['password']
+    yield {'type': 'user', **record}
+
+    archive = get_archive()
+
+    # Archived messages first, since they're the oldest. A month archived
+    # again after a failed run may also still be live; keep one copy.
+    archived_ids = set()
+    for row in archive.rows():
+        if row['user_id'] == user.id and row['id'] not in archived_ids:
+            archived_ids.add(row['id'])
+            yield {'type': 'message', 'id': row['id'], 'text': row['text'],
+                   'timestamp': row['timestamp']}
+
+    messages = (Message
+                .query
+                .with_entities(Message.id, Message.text, Message.timestamp)
+                .filter(Message.user_id == user.id)
+                .order_by(Message.id)
+                .yield_per(BATCH_SIZE))
+    for message_id, text, timestamp in messages:
+        if message_id not in archived_ids:
+            yield {'type': 'message', 'id': message_id, 'text': text,
+                   'timestamp': timestamp}
+
+    following = (User
+                 .query
+                 .with_entities(User.id, User.username)
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user.id)
+                 .yield_per(BATCH_SIZE))
+    for user_id, username in following:
+        yield {'type': 'following', 'id': user_id, 'username': username}
+
+    followers = (User
+                 .query
+                 .with_entities(User.id, User.username)
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user.id)
+                 .yield_per(BATCH_SIZE))
+    for user_id, username in followers:
+        yield {'type': 'follower', 'id': user_id, 'username': username}
+
+    likes = (db.session
+             .query(Message.id, Message.timestamp, User.username)
+             .join(Likes, Likes.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user.id)
+             .yield_per(BATCH_SIZE))
+    for message_id, timestamp, author in likes:
+        yield {'type': 'like', 'id': message_id, 'timestamp': timestamp,
+               'author': author}
+
+    # Likes whose message has been archived have nothing to join to.
+    archived_likes = (db.session
+                      .query(Likes.message_id)
+                      .filter(Likes.user_id == user.id)
+                      .filter(~db.session.query(Message.id)
+                              .filter(Message.id == Likes.message_id)
+                              .exists())
+                      .yield_per(BATCH_SIZE))
+    for message_id, in archived_likes:
+        row = archive.find(message_id)
+        author = row and User.query.get(row['user_id'])
+        if author is not None:
+            yield {'type': 'like', 'id': message_id,
+                   'timestamp': row['timestamp'], 'author': author.username}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {value!r}")
+
+
+def to_ndjson(records):
+    """Yield one JSON line per record."""
+
+    for record in records:
+        yield json.dumps(record, default=_json_default) + "\n"
+
+
+def to_csv(records):
+    """Yield a header line, then one CSV line per record."""
+
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, FIELDS)
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow({k: v.isoformat() if isinstance(v, datetime) else v
+                         for k, v in record.items()})
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+FORMATS = {
+    'ndjson': (to_ndjson, 'application/x-ndjson'),
+    'csv': (to_csv, 'text/csv'),
+}
+
+
+##############################################################################
+# Import
+
+
+def read_ndjson(lines):
+    for line in lines:
+        if line.strip():
+            yield _parse(json.loads(line))
+
+
+def read_csv(lines):
+    for row in csv.DictReader(lines):
+        yield _parse({k: v for k, v in row.items() if v != ''})
+
+
+def _parse(record):
+    for field in INT_FIELDS:
+        if record.get(field) is not None:
+            record[field] = int(record[field])
+    if record.get('timestamp') is not None:
+        record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    return record
+
+
+def import_records(records):
+    """Create a user from an export and load their related rows.
+
+    Everything is added to the current session in batches; the caller
+    commits. Returns counts of imported and skipped records by type.
+    Raises ValueError if the export doesn't start with a user record, has
+    no password hash, or the username/email is already taken.
+    """
+
+    records = iter(records)
+    first = next(records, None)
+    if first is None or first.get('type') != 'user':
+        raise ValueError("Export must start with a user record")
+    if not first.get('password'):
+        raise ValueError("Export has no password hash; re-export with it")
+
+    taken = User.query.filter((User.username == first['username']) |
+                              (User.email == first['email'])).first()
+    if taken:
+        raise ValueError(f"User {first['username']} already exists")
+
+    user = User(**{f: first.get(f) for f in USER_FIELDS if f != 'id'})
+    db.session.add(user)
+    db.session.flush()
+
+    counts = {'user': 1}
+    kind, batch = None, []
+
+    # Batches never mix types, and each is written before the next one
+    # starts, so likes can find messages imported just before them.
+    for record in records:
+        if record.get('type') not in RELATED_TYPES:
+            raise ValueError(f"Unknown record type {record.get('type')!r}")
+
+        if record['type'] != kind or len(batch) >= BATCH_SIZE:
+            _flush(user, kind, batch, counts)
+            kind, batch = record['type'], []
+        batch.append(record)
+
+    _flush(user, kind, batch, counts)
+
+    return counts
+
+
+def _flush(user, kind, batch, counts):
+    if not batch:
+        return
+
+    if kind == 'message':
+        mappings = [{'text': r['text'], 'timestamp': r['timestamp'],
+                     'user_id': user.id} for r in batch]
+        model = Message
+
+    elif kind in ('following', 'follower'):
+        ids = (User
+               .query
+               .with_entities(User.id)
+               .filter(User.username.in_([r['username'] for r in batch])))
+        if kind == 'following':
+            mappings = [{'user_following_id': user.id,
+                         'user_being_followed_id': other_id}
+                        for other_id, in ids]
+        else:
+            mappings = [{'user_following_id': other_id,
+                         'user_being_followed_id': user.id}
+                        for other_id, in ids]
+        model = Follows
+
+    else:
+        ids = (db.session
+               .query(Message.id)
+               .join(User, User.id == Message.user_id)
+               .filter(tuple_(User.username, Message.timestamp).in_(
+                   [(r['author'], r['timestamp']) for r in batch]))
+               .filter(~db.session.query(Likes)
+                       .filter(Likes.message_id == Message.id)
+                       .exists()))
+        mappings = [{'user_id': user.id, 'message_id': message_id}
+                    for message_id, in ids]
+        model = Likes
+
+    db.session.bulk_insert_mappings(model, mappings)
+    counts[kind] = counts.get(kind, 0) + len(mappings)
+    skipped = len(batch) - len(mappings)
+    if skipped:
+        counts[f"{kind}_skipped"] = counts.get(f"{kind}_skipped", 0) + skipped
+
+
+##############################################################################
+# CLI
+
+
+@contextmanager
+def _text(binary):
+    """`binary` as text with newline='', as the csv module needs.
+
+    Without it, CRLF line breaks inside quoted fields (textarea input)
+    are turned into LF on the way through.
+    """
+
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    try:
+        yield text
+    finally:
+        text.flush()
+        text.detach()
+
+
+@users_cli.command('export')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--output', '-o', type=click.File('wb'), default='-')
+def export_command(user_id, fmt, output):
+    """Export a user's data, including the password hash."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        raise click.ClickException(f"No user {user_id}")
+
+    serialize, _ = FORMATS[fmt]
+    with _text(output) as out:
+        for chunk in serialize(export_records(user, include_password=True)):
+            out.write(chunk)
+
+
+@users_cli.command('import')
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help="Defaults to csv for .csv files, ndjson otherwise.")
+def import_command(source, fmt):
+    """Import a user exported with `flask users export`."""
+
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'ndjson'
+    reader = read_csv if fmt == 'csv' else read_ndjson
+
+    try:
+        with _text(source) as lines:
+            counts = import_records(reader(lines))
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+
+    click.echo(", ".join(f"{kind}={n}" for kind, n in sorted(counts.items())))